@@ -3,8 +3,10 @@
 import os
 os.environ.setdefault("ESCDELAY", "25")
 
+import bisect
 import chess
 import chess.pgn
+import collections
 import curses
 import datetime
 import json
@@ -12,6 +14,7 @@ import os.path
 import random
 import re
 import sys
+import threading
 import time
 
 # All of the following should be relative imports, but in Python 3
@@ -24,6 +27,7 @@ from . import engine
 from . import imui
 from . import ecodb
 from . import book
+from . import zobrist
 
 ### Configuration
 
@@ -31,7 +35,9 @@ progdir = os.path.dirname(__file__)
 config_kwargs = {
     "bin": os.path.join(progdir, "data"),
     "data": os.path.join(progdir, "data"),
-    "date": datetime.date.today().strftime("%Y-%m-%d")
+    "date": datetime.date.today().strftime("%Y-%m-%d"),
+    # Private to the user, for sockets.
+    "run": os.environ.get("XDG_RUNTIME_DIR", "") or os.path.expanduser("~/.bchess")
 }
 
 def config_subs(value):
@@ -83,6 +89,157 @@ def default_config():
         os.path.expanduser("~/.config/bchess.conf"),
         os.path.expanduser("~/.bchess.conf")))
 
+### OPPONENTS
+
+# The sources of AI moves, in the order they are tried by default.
+MOVE_SOURCES = ["forced", "cache", "book", "tablebase", "engine"]
+# Engine moves remembered per opponent.
+MOVE_CACHE_SIZE = 10000
+# Seconds the AI waits for a spare engine already searching its
+# position (see UI.ponder) before searching it itself.
+PONDER_TIMEOUT = 10
+
+class Opponent:
+    """
+    How an AI chooses its moves: a cascade of move sources, tried
+    in the order of "move_sources" (of its spec, or of the config)
+    until one has a move:
+
+    - forced: the only legal move;
+    - cache: a move remember()ed for this position in this game
+      (e.g. found by pondering), or the move the engine made in it
+      before if the engine is deterministic (has no "maxloss"),
+      unless the history matters: a draw can be claimed, or the
+      position occurred before;
+    - book: a move from its opening book (see book.of_spec), up to
+      ply "book_maxply";
+    - tablebase: the best move by the Syzygy tablebases of its
+      "syzygy" spec, with at most "tablebase_maxpieces" pieces;
+    - engine: a search by its engine.
+
+    The number of tries, hits, and the time spent are counted per
+    source.
+    """
+
+    def __init__(self, spec, ai, config={}):
+        option = lambda key, default: spec.get(key, config.get(key, default))
+        self.sources = list(option("move_sources", MOVE_SOURCES))
+        self.ai = ai
+        self.bookfn = book.of_spec(spec.get("book", None))
+        self.book_maxply = option("book_maxply", None)
+        self.tablebase = engine.tablebase(spec["syzygy"]) if spec.get("syzygy", "") else None
+        self.tablebase_maxpieces = option("tablebase_maxpieces", None)
+        self.cache_size = option("move_cache_size", MOVE_CACHE_SIZE)
+        self.cache = collections.OrderedDict()
+        # A LossyEngine picks among the good moves at random.
+        self.cache_engine = "maxloss" not in spec
+        # source -> [tries, hits, seconds]
+        self.stats = {source: [0, 0, 0.0] for source in self.sources}
+        self.lock = threading.Lock()
+
+    def play(self, board, callback, *args, tracker=None):
+        """
+        Make a move. The callback gets the move in UCI; unless it
+        comes from the engine, it is called before this returns.
+        Return the source of the move. The zobrist.Tracker of the
+        board saves recomputing its key and repetitions.
+        """
+        if tracker is None:
+            tracker = zobrist.Tracker(board)
+        source, move = self.quick_move(board, tracker=tracker)
+        if move is not None:
+            callback(move, *args)
+            return source
+        if "engine" not in self.sources or self.ai is None:
+            raise ValueError("No move source has a move")
+        with self.lock:
+            self.stats["engine"][0] += 1
+        self.ai.play(board, self._engine_callback, self._cache_key(tracker), time.perf_counter(), callback, args)
+        return "engine"
+
+    def quick_move(self, board, record=True, tracker=None):
+        """
+        Return (source, move) from the sources before the engine,
+        or (None, None) if none of them has a move.
+        """
+        if tracker is None:
+            tracker = zobrist.Tracker(board)
+        for source in self.sources:
+            if source == "engine": continue
+            t = time.perf_counter()
+            move = getattr(self, "_move_" + source)(board, tracker)
+            if record:
+                with self.lock:
+                    stats = self.stats[source]
+                    stats[0] += 1
+                    stats[1] += move is not None
+                    stats[2] += time.perf_counter() - t
+            if move is not None:
+                return source, move
+        return None, None
+
+    def remember(self, board, move):
+        self._store(zobrist.key(board), move)
+
+    def forget(self):
+        """Empty the cache, e.g. when the game is taken back."""
+        with self.lock:
+            self.cache.clear()
+
+    def _store(self, key, move):
+        with self.lock:
+            self.cache[key] = move
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def source_stats(self):
+        """Return {source: {"tries", "hits", "ms"}}, ms being the time spent in total."""
+        with self.lock:
+            return {source: {"tries": tries, "hits": hits, "ms": round(seconds*1000, 3)}
+                for source, (tries, hits, seconds) in self.stats.items()}
+
+    def _move_forced(self, board, tracker):
+        moves = iter(board.legal_moves)
+        move = next(moves, None)
+        if move is None or next(moves, None) is not None:
+            return None
+        return move.uci()
+
+    def _cache_key(self, tracker):
+        # The key of a position does not tell its history, which
+        # the engine is told about.
+        if tracker.occurrences() > 1 or tracker.can_claim_draw():
+            return None
+        return tracker.key
+
+    def _move_cache(self, board, tracker):
+        key = self._cache_key(tracker)
+        if key is None: return None
+        with self.lock:
+            return self.cache.get(key, None)
+
+    def _move_book(self, board, tracker):
+        if not self.bookfn: return None
+        if self.book_maxply is not None and board.ply() >= self.book_maxply: return None
+        return self.bookfn(board)
+
+    def _move_tablebase(self, board, tracker):
+        if not self.tablebase: return None
+        if self.tablebase_maxpieces is not None and chess.popcount(board.occupied) > self.tablebase_maxpieces:
+            return None
+        result = self.tablebase.best_move(board)
+        return result[0] if result else None
+
+    def _engine_callback(self, move, key, t, callback, args):
+        with self.lock:
+            stats = self.stats["engine"]
+            stats[1] += 1
+            stats[2] += time.perf_counter() - t
+        if self.cache_engine and key is not None:
+            self._store(key, move)
+        callback(move, *args)
+
 ### MISC UI
 
 def FormatText(text, attr=0):
@@ -136,6 +293,69 @@ def highlight_san_move(text, board=None):
     if not x and not f2 and not r2: ss |= squareset(pc, None, None, None, f1, r1)
     return ss
 
+class LegalIndex:
+    """
+    The legal moves of a position by their names: SAN (with or
+    without the check mark), and UCI; built once per position, for
+    parsing and highlighting the move being typed.
+
+    Names are matched in any case ("nf3" is Nf3) when the exact
+    case matches nothing; if two moves have the same name but for
+    the case, the pawn move wins, so "bxc3" is still the b-pawn.
+    """
+
+    def __init__(self, board, key=None):
+        self.key = key
+        self.san = {}
+        self.moves = {}
+        for move in board.legal_moves:
+            san = board.san(move)
+            self.san[move] = san
+            for name in (san, san.rstrip("+#"), move.uci()):
+                self.moves.setdefault(name, move)
+        self.names = sorted(self.moves)
+        # The names in lower case; pawn moves (and UCI names) are
+        # the ones already in lower case.
+        self.folded = {}
+        for name in sorted(self.moves, key=lambda name: name[0].isupper()):
+            self.folded.setdefault(name.lower(), self.moves[name])
+        self.folded_names = sorted(self.folded)
+
+    def find(self, name):
+        """Return the move with a name, or None."""
+        move = self.moves.get(name, None)
+        return move if move is not None else self.folded.get(name.lower(), None)
+
+    def complete(self, prefix):
+        """Return the moves with a name that starts with a (non-empty) prefix."""
+        if not prefix: return []
+        return self._complete(self.names, self.moves, prefix) or \
+               self._complete(self.folded_names, self.folded, prefix.lower())
+
+    @staticmethod
+    def _complete(names, moves, prefix):
+        result = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            move = moves[names[i]]
+            if move not in result:
+                result.append(move)
+            i += 1
+        return result
+
+    def highlight(self, prefix):
+        """
+        Return the squares of the moves the prefix may be the
+        start of, or None if there are none.
+        """
+        moves = self.complete(prefix)
+        if not moves: return None
+        ss = chess.SquareSet()
+        for move in moves:
+            ss.add(move.from_square)
+            ss.add(move.to_square)
+        return ss
+
 piece_material = [None, 1, 3, 3, 5, 9, 100]
 
 def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv=()):
@@ -177,6 +397,9 @@ def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv
         win, loss = evalbar
         bar_white = min(max(int(8*3*win), 1), 8*3 - 1)
         bar_black = 8*3 - min(max(int(8*3*loss), 1), 8*3 - 1)
+    # The mouse events over the squares, to be handled in the order
+    # they came in: a quick drag may both start and end in a frame.
+    clicks = []
     with im.Table(2,6,6,6,6,6,6,6,6,2):
         # Top frame
         with im.Row():
@@ -193,18 +416,19 @@ def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv
                 with im.Cell():
                     if flip:
                         if evalbar:
-                            aw = 3*rank + 0 < bar_white
-                            al = 3*rank + 0 >= bar_black
-                            bw = 3*rank + 1 < bar_white
-                            bl = 3*rank + 1 >= bar_black
-                            cw = 3*rank + 2 < bar_white
-                            cl = 3*rank + 2 >= bar_black
-                            a = self.attr_eval_w if aw else self.attr_eval_l if al else self.attr_eval_w
-                            b = self.attr_eval_w if bw else self.attr_eval_l if bl else self.attr_eval_w
-                            c = self.attr_eval_w if cw else self.attr_eval_l if cl else self.attr_eval_w
-                            im.Text("█ " if aw or al else "░ ", attr=a)
-                            im.Text("█ " if bw or bl else "░ ", attr=b)
-                            im.Text("█ " if cw or cl else "░ ", attr=c)
+                            with im.Region("evalbar"):
+                                aw = 3*rank + 0 < bar_white
+                                al = 3*rank + 0 >= bar_black
+                                bw = 3*rank + 1 < bar_white
+                                bl = 3*rank + 1 >= bar_black
+                                cw = 3*rank + 2 < bar_white
+                                cl = 3*rank + 2 >= bar_black
+                                a = self.attr_eval_w if aw else self.attr_eval_l if al else self.attr_eval_w
+                                b = self.attr_eval_w if bw else self.attr_eval_l if bl else self.attr_eval_w
+                                c = self.attr_eval_w if cw else self.attr_eval_l if cl else self.attr_eval_w
+                                im.Text("█ " if aw or al else "░ ", attr=a)
+                                im.Text("█ " if bw or bl else "░ ", attr=b)
+                                im.Text("█ " if cw or cl else "░ ", attr=c)
                     else:
                         name = ord("1") + rank
                         im.Text("  ", attr=self.attr_border)
@@ -215,14 +439,10 @@ def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv
                     light = (rank ^ file) & 1
                     with im.Cell():
                         if self.ai[self.board.turn] is None and \
-                                not self.board.is_game_over(claim_draw=self.draw) and \
-                                im.MouseClick(im.curx, im.cury, 6, 3):
+                                not self.tracker.is_game_over(claim_draw=self.draw):
                             square = chr(ord("a") + file) + chr(ord("1") + rank)
-                            self.move = \
-                                    self.move[:-2] if self.move.endswith(square) else \
-                                    self.move + square + "\n"
-                            self.try_user_move()
-                            im.want_refresh = True
+                            for order, event in im.MouseEvents(im.curx, im.cury, 6, 3):
+                                clicks.append((order, event, square))
                         hi = chess.square(file, rank) in hi_squares
                         mv = chess.square(file, rank) in mv_squares
                         p = board.piece_at(chess.square(file, rank))
@@ -245,18 +465,19 @@ def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv
                         im.Text("  ", attr=self.attr_border)
                     else:
                         if evalbar:
-                            aw = 3*rank + 0 < bar_white
-                            al = 3*rank + 0 >= bar_black
-                            bw = 3*rank + 1 < bar_white
-                            bl = 3*rank + 1 >= bar_black
-                            cw = 3*rank + 2 < bar_white
-                            cl = 3*rank + 2 >= bar_black
-                            a = self.attr_eval_w if aw else self.attr_eval_l if al else self.attr_eval_w
-                            b = self.attr_eval_w if bw else self.attr_eval_l if bl else self.attr_eval_w
-                            c = self.attr_eval_w if cw else self.attr_eval_l if cl else self.attr_eval_w
-                            im.Text(" █" if cw or cl else " ░", attr=c)
-                            im.Text(" █" if bw or bl else " ░", attr=b)
-                            im.Text(" █" if aw or al else " ░", attr=a)
+                            with im.Region("evalbar"):
+                                aw = 3*rank + 0 < bar_white
+                                al = 3*rank + 0 >= bar_black
+                                bw = 3*rank + 1 < bar_white
+                                bl = 3*rank + 1 >= bar_black
+                                cw = 3*rank + 2 < bar_white
+                                cl = 3*rank + 2 >= bar_black
+                                a = self.attr_eval_w if aw else self.attr_eval_l if al else self.attr_eval_w
+                                b = self.attr_eval_w if bw else self.attr_eval_l if bl else self.attr_eval_w
+                                c = self.attr_eval_w if cw else self.attr_eval_l if cl else self.attr_eval_w
+                                im.Text(" █" if cw or cl else " ░", attr=c)
+                                im.Text(" █" if bw or bl else " ░", attr=b)
+                                im.Text(" █" if aw or al else " ░", attr=a)
         # Bottom frame
         with im.Row():
             with im.Cell(): im.Text("  ", attr=self.attr_border)
@@ -265,6 +486,19 @@ def ChessBoard(self, board, hi_squares, mv_squares, flip=False, evalbar=None, pv
                     name = ord("a") + file
                     im.Text("      " if flip else f"  {name:c}   ", attr=self.attr_border)
             with im.Cell(): im.Text("  ", attr=self.attr_border)
+    for order, event, square in sorted(clicks):
+        if event is imui.EventMousePress:
+            self.move = \
+                    self.move[:-2] if self.move.endswith(square) else \
+                    self.move + square + "\n"
+        elif self.move and not self.move.endswith(square):
+            # Releasing the button over another square completes
+            # a drag started on the first one.
+            self.move = self.move + square + "\n"
+        else:
+            continue
+        self.try_user_move()
+        im.want_refresh = True
 
 def MoveList(self, moves, hi=None, maxheight=24, attr=0, hi_attr=0):
     n = (len(moves) + 1)//2
@@ -308,6 +542,38 @@ class UI0:
         self.ai_index = imui.Ref(0)
         self.color_index = imui.Ref(1)
         self.ailist = list(config["ai"].values())
+        # Engines are started ahead of time, while the user is
+        # still choosing, so that the ones slow to load (e.g. lc0
+        # with its weights) are ready when the game starts.
+        self.spec_ai = None
+        self.spec_engine = None
+        self.eval_engine = engine.of_spec(config["eval_ai"]) if config.get("eval_ai") else None
+
+    def speculate(self, aispec):
+        """
+        Start the engine for the highlighted opponent, and quit
+        the one started for the previously highlighted one.
+        """
+        if aispec is self.spec_ai: return
+        if self.spec_engine:
+            self.spec_engine.quit()
+        self.spec_ai = aispec
+        self.spec_engine = engine.of_spec(aispec)
+
+    def quit_engines(self):
+        for eng in (self.spec_engine, self.eval_engine):
+            if eng: eng.quit()
+        self.spec_ai = self.spec_engine = self.eval_engine = None
+
+    def start(self, white_ai, black_ai):
+        ai = white_ai or black_ai
+        ai_engine = self.spec_engine if ai is self.spec_ai else None
+        if ai_engine is None and self.spec_engine:
+            # E.g. the selection moved in the same frame.
+            self.spec_engine.quit()
+        ui = UI(white_ai, black_ai, self.config, ai_engine=ai_engine, eval_engine=self.eval_engine)
+        self.spec_ai = self.spec_engine = self.eval_engine = None
+        set_scene(ui.render)
 
     def render(self):
         with im.Center(width=60, height=10 + len(self.ailist) + len(self.config["rating_classes"])):
@@ -352,16 +618,21 @@ class UI0:
                             True if self.color_index() == 2 else \
                             random.choice((True,False))
                         if usercolor:
-                            set_scene(UI(None, allais[self.ai_index()], self.config).render)
+                            self.start(None, allais[self.ai_index()])
                         else:
-                            set_scene(UI(allais[self.ai_index()], None, self.config).render)
+                            self.start(allais[self.ai_index()], None)
+                        return
             im.VSpace(1)
             aispec = allais[self.ai_index()]
+            self.speculate(aispec)
             im.Text(f"{aispec['name']}", attr=curses.A_BOLD)
             FormatText(aispec.get("description", ""))
 
 class UI:
-    def __init__(self, white_ai, black_ai, config):
+    def __init__(self, white_ai, black_ai, config, ai_engine=None, eval_engine=None):
+        # The engine callbacks come from other threads, and must
+        # reach the IM of this UI even if im is switched meanwhile.
+        self.im = im
         self.attr_piece = [
             # piece w/b -- square l/d
             config["style"]["square_bd"], # 0b00
@@ -396,27 +667,64 @@ class UI:
         self.flip = False if white_ai is None else True
         self.help = False
         self.pgn_filename = config["pgn_filename"]
-        self.user_name = os.environ.get("USER", "user")
+        # The game is saved after each move; bchess-server gives
+        # each session its own file, and user name.
+        self.pgn_autosave = config.get("pgn_autosave", "/tmp/bchess.pgn")
+        self.user_name = config.get("user_name", "") or os.environ.get("USER", "user")
         self.board = chess.Board()
+        # Moves are pushed and popped through the tracker.
+        self.tracker = zobrist.Tracker(self.board)
+        self.legal = None
         self.move_index = None
         self.san_moves = []
         self.eval = {}
         self.eval_maxdepth = {}
         self.aispec = (black_ai, white_ai)
-        self.book = (
-            book.of_spec(black_ai.get("book", None)) if black_ai else None,
-            book.of_spec(white_ai.get("book", None)) if white_ai else None
+        # The engines can be started by the caller beforehand.
+        self.ai = (
+            (ai_engine or engine.of_spec(black_ai)) if black_ai else None,
+            (ai_engine or engine.of_spec(white_ai)) if white_ai else None
+        )
+        self.opponent = (
+            Opponent(black_ai, self.ai[0], config) if black_ai else None,
+            Opponent(white_ai, self.ai[1], config) if white_ai else None
         )
-        self.ai = (engine.of_spec(black_ai) if black_ai else None, engine.of_spec(white_ai) if white_ai else None)
-        self.eval_ai = engine.of_spec(config["eval_ai"])
+        self.eval_ai = eval_engine or (engine.of_spec(config["eval_ai"]) if config.get("eval_ai") else None)
+        # While the user thinks, spare engines of the opponent
+        # precompute its replies to the likely user moves: the
+        # popular book moves of humans rated like the opponent,
+        # and the best move according to eval_ai.
+        aispec = black_ai or white_ai
+        self.ponder_ai = [engine.of_spec(aispec) for i in range(config.get("ponder_engines", 0))] \
+            if (black_ai is None) != (white_ai is None) else []
+        self.ponder_idle = list(self.ponder_ai)
+        self.ponder_moves = config.get("ponder_moves", 3)
+        self.ponder_rating = None
+        if self.ponder_ai and book.default is not None:
+            ratings = book.default.available_ratings()
+            if ratings:
+                self.ponder_rating = min(ratings, key=lambda r: abs(r - aispec.get("rating", 1500)))
+        self.ponder_queue = collections.deque()
+        # The keys of the positions queued (with their boards) or being
+        # searched, and the replies found.
+        self.ponder_keys = set()
+        self.ponder_replies = {}
+        # The position the AI is waiting for a spare engine on.
+        self.ponder_wanted = None
+        # Why the AI can't move, if it can't.
+        self.ai_error = None
         self.move = ""
         self.draw = False
         self.pgn_root = chess.pgn.Game()
         self.pgn = self.pgn_root
         if self.eval_ai:
-            self.eval_ai.analyze(self.board, self.eval_ai_update, self.board.fen())
+            self.eval_ai.analyze(self.board, self.eval_ai_update, self.tracker.key)
         self.prepare_ai_move()
 
+    def quit_engines(self):
+        for eng in set(self.ai + (self.eval_ai,) + tuple(self.ponder_ai)):
+            if eng: eng.quit()
+
     def save_pgn(self, filename):
         game = chess.pgn.Game()
         game.headers["White"] = self.aispec[1]["name"] if self.aispec[1] else self.user_name
@@ -425,20 +733,19 @@ class UI:
         game.headers["Event"] = "??"
         game.headers["Site"] = "??"
         game.headers["Round"] = "1"
-        game.headers["Result"] = self.board.result(claim_draw=self.draw)
+        game.headers["Result"] = self.tracker.result(claim_draw=self.draw)
         if self.eval_ai:
             game.headers["Annotator"] = self.eval_ai.id.get("name", self.eval_ai.exepath)
         node = game
-        board = chess.Board()
         opening = ""
-        for move in self.board.move_stack:
+        eco = ecodb.by_key()
+        for move, (key, state) in zip(self.board.move_stack, self.tracker.keys[1:]):
             node = node.add_main_variation(move)
-            board.push(move)
-            ev = self.eval.get(board.fen(), None)
+            ev = self.eval.get(key, None)
             if ev:
                 ev = max(ev.items(), key=lambda kv: kv[0])[1]
                 node.comment = f"[%eval {engine.score_eval(ev.score, ev.depth)}]"
-            opening = ecodb.db.get(board.epd(), opening)
+            opening = eco.get(key, opening)
         eco, opening, variation = opening.split(":", 2)
         if eco: game.headers["ECO"] = eco
         if opening: game.headers["Opening"] = opening
@@ -449,7 +756,7 @@ class UI:
 
     def apply_move(self, move):
         if move == "draw":
-            if not self.board.can_claim_draw():
+            if not self.tracker.can_claim_draw():
                 raise ValueError("No basis to claim draw now.")
             self.draw = True
         elif move == "undo":
@@ -457,16 +764,18 @@ class UI:
                 raise ValueError("Undo what?")
             if self.move_index is not None:
                 while len(self.board.move_stack) > self.move_index:
-                    self.board.pop()
-                    self.board.pop()
+                    self.tracker.pop()
+                    self.tracker.pop()
                     self.san_moves.pop()
                     self.san_moves.pop()
                 self.move_index = None
             else:
-                self.board.pop()
-                self.board.pop()
+                self.tracker.pop()
+                self.tracker.pop()
                 self.san_moves.pop()
                 self.san_moves.pop()
+            for opponent in self.opponent:
+                if opponent: opponent.forget()
         elif move == "flip":
             self.flip = not self.flip
         elif move in ("quit", "exit", "resign"):
@@ -474,30 +783,139 @@ class UI:
         elif move == "help":
             self.help = not self.help
         else:
-            try:
-                move = self.board.parse_uci(move)
-            except:
-                move = self.board.parse_san(move)
-            san = self.board.san(move)
-            self.board.push(move)
+            index = self.legal_index()
+            found = index.find(move)
+            if found is None:
+                # Other spellings, e.g. "0-0" or "Ng1f3".
+                try:
+                    found = self.board.parse_uci(move)
+                except:
+                    found = self.board.parse_san(move)
+            move = found
+            san = index.san.get(move, None) or self.board.san(move)
+            self.tracker.push(move)
             self.san_moves.append(san)
-        if self.board.move_stack:
-            self.save_pgn("/tmp/bchess.pgn")
-        if not self.board.is_game_over(claim_draw=self.draw):
+        if self.board.move_stack and self.pgn_autosave:
+            self.save_pgn(self.pgn_autosave)
+        if not self.tracker.is_game_over(claim_draw=self.draw):
             if self.eval_ai:
-                self.eval_ai.analyze(self.board, self.eval_ai_update, self.board.fen())
+                self.eval_ai.analyze(self.board, self.eval_ai_update, self.tracker.key)
             self.prepare_ai_move()
         im.want_refresh = True
 
     def prepare_ai_move(self):
+        self.ai_error = None
         ai = self.ai[self.board.turn]
         if ai:
-            book = self.book[self.board.turn]
-            bookmove = book(self.board) if book else None
-            if bookmove:
-                self.ai_update(bookmove)
+            key = self.tracker.key
+            reply = self.ponder_replies.get(key, None)
+            searching = key in self.ponder_keys and all(k != key for k, b in self.ponder_queue)
+            self.ponder_queue.clear()
+            self.ponder_keys.clear()
+            self.ponder_replies.clear()
+            opponent = self.opponent[self.board.turn]
+            if reply:
+                opponent.remember(self.board, reply)
+            if searching and not reply:
+                # A spare engine is searching this position already
+                # (unless it died or hangs: see ponder_timeout).
+                self.ponder_wanted = key
+                timer = threading.Timer(PONDER_TIMEOUT, self.im.run_soon, (lambda: self.ponder_timeout(key),))
+                timer.daemon = True
+                timer.start()
             else:
-                ai.play(self.board, self.ai_update)
+                self.play_ai()
+        elif self.ponder_ai and not self.tracker.is_game_over(claim_draw=self.draw):
+            self.ponder()
+
+    def play_ai(self):
+        try:
+            self.opponent[self.board.turn].play(self.board, self.ai_update, tracker=self.tracker)
+        except ValueError as e:
+            self.ai_error = str(e)
+
+    def ponder_timeout(self, key):
+        """
+        Search the position the AI is still waiting for a spare
+        engine on with its own engine; the first to answer wins.
+        """
+        if key != self.ponder_wanted or key != self.tracker.key: return
+        self.ponder_wanted = None
+        self.play_ai()
+        im.want_refresh = True
+
+    def ponder(self):
+        """
+        Queue the likely user moves for the spare engines.
+        """
+        self.ponder_wanted = None
+        self.ponder_keys.clear()
+        self.ponder_replies.clear()
+        if self.ponder_rating is not None:
+            moves, counts = book.default.moves(book.default.position(self.board, self.tracker.key), self.ponder_rating)
+            for count, move in sorted(zip(counts, moves), reverse=True):
+                self.ponder_add(move)
+        self.ponder_next()
+
+    def ponder_add(self, move):
+        if len(self.ponder_keys) >= self.ponder_moves: return
+        self.tracker.push_uci(move)
+        try:
+            if self.tracker.is_game_over(claim_draw=self.draw): return
+            key = self.tracker.key
+            if key in self.ponder_keys: return
+            # A book (or forced, ...) reply is instant anyway.
+            if self.opponent[self.board.turn].quick_move(self.board, record=False, tracker=self.tracker)[1]: return
+            board = self.board.copy()
+        finally:
+            self.tracker.pop()
+        self.ponder_keys.add(key)
+        self.ponder_queue.append((key, board))
+
+    def ponder_next(self):
+        while self.ponder_idle and self.ponder_queue:
+            key, board = self.ponder_queue.popleft()
+            eng = self.ponder_idle.pop()
+            eng.play(board, self.ponder_update, eng, key)
+
+    def ponder_update(self, move, eng, key):
+        self.im.run_soon(lambda: self.ponder_done(move, eng, key))
+
+    def ponder_done(self, move, eng, key):
+        self.ponder_idle.append(eng)
+        if key == self.ponder_wanted:
+            self.ponder_wanted = None
+            self.ai_update(move)
+        elif key in self.ponder_keys:
+            self.ponder_replies[key] = move
+        self.ponder_next()
+
+    def ponder_pv(self, key):
+        """
+        Queue the best move according to eval_ai, once its search
+        of the current position is done.
+        """
+        if key != self.tracker.key or self.ai[self.board.turn]: return
+        if self.tracker.is_game_over(claim_draw=self.draw): return
+        depth = self.eval_maxdepth.get(key, None)
+        if depth is None or not self.eval[key][depth].pv: return
+        self.ponder_add(self.eval[key][depth].pv[0])
+        self.ponder_next()
+
+    def legal_index(self):
+        """The LegalIndex of the current position."""
+        if self.legal is None or self.legal.key != self.tracker.key:
+            self.legal = LegalIndex(self.board, self.tracker.key)
+        return self.legal
+
+    def move_hint(self):
+        """The moves the text typed so far may be the start of."""
+        if not self.move or "\n" in self.move: return ""
+        moves = self.legal_index().complete(self.move)
+        if not 1 <= len(moves) <= 6: return ""
+        sans = sorted(self.legal.san[move] for move in moves)
+        if sans == [self.move]: return ""
+        return ", ".join(sans) + "?"
 
     def try_user_move(self):
         if "\n" not in self.move: return
@@ -521,7 +939,9 @@ class UI:
             board = board.copy()
             while len(board.move_stack) > self.move_index:
                 board.pop()
-        hi_squares = highlight_san_move(self.move, board)
+        hi_squares = self.legal_index().highlight(self.move) if board is self.board else None
+        if hi_squares is None:
+            hi_squares = highlight_san_move(self.move, board)
         mv_squares = chess.SquareSet()
         if board.move_stack:
             m = board.move_stack[-1]
@@ -530,19 +950,23 @@ class UI:
         if board.is_check():
             mv_squares.add(board.king(board.turn))
         with im.Center(width=52+1+20, height=26+3-1):
-            evdepth = self.eval_maxdepth.get(board.fen(), None)
-            ev = self.eval.get(board.fen(), None)
+            key = self.tracker.keys[len(board.move_stack)][0]
+            evdepth = self.eval_maxdepth.get(key, None)
+            ev = self.eval.get(key, None)
             with im.Table(52, 20, margin=1):
                 with im.Row():
                     with im.Cell():
                         if self.help and evdepth and ev:
-                            evalbar = [engine.score_winpercent(e.score) for d, e in sorted(ev.items()) if d <= evdepth]
-                            evalbar = [min(evalbar[-4:]), 1-max(evalbar[-4:])]
-                            ChessBoard(self, board, hi_squares, mv_squares, evalbar=evalbar, pv=ev[evdepth].pv, flip=self.flip)
+                            with im.Region("evalbar"):
+                                evalbar = [engine.score_winpercent(e.score) for d, e in sorted(ev.items()) if d <= evdepth]
+                                evalbar = [min(evalbar[-4:]), 1-max(evalbar[-4:])]
+                            with im.Region("ChessBoard"):
+                                ChessBoard(self, board, hi_squares, mv_squares, evalbar=evalbar, pv=ev[evdepth].pv, flip=self.flip)
                         else:
-                            ChessBoard(self, board, hi_squares, mv_squares, flip=self.flip)
-                        if self.board.is_game_over(claim_draw=self.draw):
-                            im.Text(self.board.result(claim_draw=self.draw), attr=self.attr_input, align=1)
+                            with im.Region("ChessBoard"):
+                                ChessBoard(self, board, hi_squares, mv_squares, flip=self.flip)
+                        if self.tracker.is_game_over(claim_draw=self.draw):
+                            im.Text(self.tracker.result(claim_draw=self.draw), attr=self.attr_input, align=1)
                             im.VSpace(1)
                             self.move, chg = im.Input(self.move, prefix="Game over. ", attr=self.attr_input, align=1)
                             if chg: im.want_refresh = True
@@ -551,17 +975,28 @@ class UI:
                         else:
                             # Move input field
                             if self.ai[self.board.turn] is None:
-                                if self.board.can_claim_fifty_moves():
+                                if self.tracker.can_claim_fifty_moves():
                                     im.Text("You can now claim draw by the fifty-move rule.", align=1)
-                                if self.board.can_claim_threefold_repetition():
+                                if self.tracker.can_claim_threefold_repetition():
                                     im.Text("You can now claim draw by threefold repetition.", align=1)
-                                im.VSpace(1)
+                                hint = self.move_hint()
+                                if hint:
+                                    im.Text(hint, align=1)
+                                else:
+                                    im.VSpace(1)
                                 prefix = f"Move {self.board.fullmove_number}. " if self.board.turn else \
                                          f"Move {self.board.fullmove_number}... "
                                 self.move, chg = im.Input(self.move, prefix=prefix, attr=self.attr_input, align=1)
                                 if chg: im.want_refresh = True
                                 if "\n" in self.move:
                                     self.try_user_move()
+                            elif self.ai_error:
+                                # Let the user move for the AI, or undo.
+                                im.Text(self.ai_error + ".", align=1)
+                                self.move, chg = im.Input(self.move, prefix="Move for it: ", attr=self.attr_input, align=1)
+                                if chg: im.want_refresh = True
+                                if "\n" in self.move:
+                                    self.try_user_move()
                             else:
                                 im.VSpace(1)
                                 self.move, chg = im.Input(self.move, prefix="Thinking... ", attr=self.attr_input, align=1)
@@ -569,9 +1004,29 @@ class UI:
                     with im.Cell():
                         im.VSpace(3)
                         moves = self.san_moves
-                        if not self.board.is_game_over(claim_draw=self.draw):
+                        if not self.tracker.is_game_over(claim_draw=self.draw):
                             moves = moves + ["??" if self.ai[self.board.turn] is None else ".."]
-                        MoveList(self, moves, hi=self.move_index, maxheight=8*3, attr=self.attr_move, hi_attr=self.attr_move_hi)
+                        sources = self.source_lines() if self.help else []
+                        with im.Region("MoveList"):
+                            MoveList(self, moves, hi=self.move_index, maxheight=8*3 - len(sources) - bool(sources), attr=self.attr_move, hi_attr=self.attr_move_hi)
+                        if sources:
+                            im.VSpace(1)
+                        for line in sources:
+                            im.Text(line, attr=self.attr_move)
+
+    def source_lines(self):
+        """
+        How many AI moves came from each source, and the time a try
+        of it takes on average, for the help view.
+        """
+        stats = {}
+        for opponent in self.opponent:
+            if opponent is None: continue
+            for source, st in opponent.source_stats().items():
+                tries, hits, ms = stats.get(source, (0, 0, 0.0))
+                stats[source] = (tries + st["tries"], hits + st["hits"], ms + st["ms"])
+        return [f"{source:<9}{hits:>3}{ms/tries:>6.0f}ms"
+            for source, (tries, hits, ms) in stats.items() if hits]
 
     def rewind(self, move_index):
         move_index = max(move_index, 0)
@@ -582,31 +1037,34 @@ class UI:
         # The update here must be delayed because:
         # 1) ai_update might get called from an AI thread;
         # 2) ai_update might get called from apply_move itself (for a book move).
-        im.run_soon(lambda: self.apply_move(move))
+        self.im.run_soon(lambda: self.apply_move(move))
 
-    def eval_ai_update(self, result, fen):
+    def eval_ai_update(self, result, key):
         if isinstance(result, engine.Evaluation):
             if result.depth >= 4:
-                self.eval.setdefault(fen, {})
-                self.eval[fen][result.depth] = result
-                if result.depth - 1 in self.eval[fen]:
-                    self.eval_maxdepth[fen] = result.depth - 1
-                im.want_refresh = True
+                self.eval.setdefault(key, {})
+                self.eval[key][result.depth] = result
+                if result.depth - 1 in self.eval[key]:
+                    self.eval_maxdepth[key] = result.depth - 1
+                self.im.invalidate()
         elif isinstance(result, engine.BestMove):
-            if fen in self.eval:
-                self.eval_maxdepth[fen] = max(self.eval[fen].keys())
+            if key in self.eval:
+                self.eval_maxdepth[key] = max(self.eval[key].keys())
+                self.im.invalidate()
+                if self.ponder_ai:
+                    self.im.run_soon(lambda: self.ponder_pv(key))
 
 ### MAIN
 
-def config_implement_colors(conf):
+def config_implement_colors(conf, init_pair=curses.init_pair, color_pair=curses.color_pair):
     colors = {(-1, -1): 0}
     colorn = 1
     for a in conf.values():
         fg = a.get("fg", -1)
         bg = a.get("bg", -1)
         if (fg, bg) in colors: continue
-        curses.init_pair(colorn, fg, bg)
-        colors[fg, bg] = curses.color_pair(colorn)
+        init_pair(colorn, fg, bg)
+        colors[fg, bg] = color_pair(colorn)
         colorn += 1
     result = {}
     for key, a in list(conf.items()):
@@ -629,26 +1087,48 @@ def curses_main(win):
     curses.start_color()
     curses.use_default_colors()
     config["style"] = config_implement_colors(config["style"])
+    im.max_fps = config.get("max_fps", im.max_fps)
     set_scene(UI0(config).render)
     curses.cbreak()
     curses.mousemask(-1)
     curses.mouseinterval(0)
+    show_profile = False
     while True:
         with im.Frame(win):
+            if im.profiler is not None and im.Key(curses.KEY_F12):
+                show_profile = not show_profile
             UI_RENDERER()
+            if show_profile:
+                im.ProfileOverlay()
             if im.Key("q"):
                 break
-        while not (im.want_refresh or im.gather_input(win)):
+        while not (im.want_refresh or im.gather_input(win) or im.frame_due()):
             pass
 
 def main():
     global im
     im = imui.IM()
+    # Set BCHESS_PROFILE to a file name to collect frame timings;
+    # press F12 to see them, and find them in that file at exit.
+    profile = os.environ.get("BCHESS_PROFILE", None)
+    if profile:
+        im.profiler = imui.Profiler()
     book.default = book.BookDB(config_subs("{data}/openings.sqlite"))
+    # Use the engines of bchess-engined, if it is running.
+    socket_path = default_config().get("engined_socket", "")
+    if socket_path:
+        engine.daemon = engine.DaemonClient.connect(socket_path)
+    if sys.argv[1:2] == ["serve-moves"]:
+        from . import moveserver
+        moveserver.main(sys.argv[2:])
+        return
     try:
         curses.wrapper(curses_main)
     except KeyboardInterrupt:
         pass
+    finally:
+        if profile:
+            im.profiler.dump(profile)
 
 if __name__ == "__main__":
     main()
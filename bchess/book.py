@@ -1,10 +1,106 @@
 import random
 import sqlite3
+import struct
+
+from . import zobrist
+
+# Compacted evaluations keep one row per board, with the scores of
+# the last PACKED_DEPTHS depths as 32-bit integers (a mate in N is
+# MATE_SCORE-N, mated in N is -MATE_SCORE+N), and only the deepest
+# PV, as 16-bit moves: from | to << 6 | promotion piece type << 12
+# (0, which would be a1a1, is the null move "0000").
+PACKED_DEPTHS = 4
+MATE_SCORE = 1000000
+
+SQUARE_NAMES = [f + r for r in "12345678" for f in "abcdefgh"]
+SQUARE_INDEX = {name: i for i, name in enumerate(SQUARE_NAMES)}
+PROMOTION_NAMES = ["", "", "n", "b", "r", "q"]
+
+def pack_score(score):
+    if score.startswith("cp "):
+        return int(score[3:])
+    if score.startswith("mate "):
+        n = int(score[5:])
+        return MATE_SCORE - n if n > 0 else -MATE_SCORE - n
+    raise ValueError("Bad score format: " + repr(score))
+
+def unpack_score(value):
+    if value > MATE_SCORE//2:
+        return f"mate {MATE_SCORE - value}"
+    if value < -MATE_SCORE//2:
+        return f"mate {-MATE_SCORE - value}"
+    return f"cp {value}"
+
+def pack_pv(pv):
+    moves = [
+        0 if m == "0000" else
+        SQUARE_INDEX[m[0:2]] | SQUARE_INDEX[m[2:4]] << 6 | PROMOTION_NAMES.index(m[4:]) << 12
+        for m in pv.split()
+    ]
+    return struct.pack(f"<{len(moves)}H", *moves)
+
+def unpack_pv(data):
+    return " ".join(
+        "0000" if m == 0 else
+        SQUARE_NAMES[m & 63] + SQUARE_NAMES[(m >> 6) & 63] + PROMOTION_NAMES[m >> 12]
+        for m, in struct.iter_unpack("<H", data)
+    )
+
+def compact_evaluations(db):
+    """
+    Fill the packed_evaluations table of a database from its
+    evaluations table (with a row per board and depth).
+    """
+    def rows():
+        last = None
+        evals = []
+        for row in db.execute("select boardid, depth, score, pv from evaluations order by boardid, depth"):
+            if evals and row[0] != last:
+                yield pack_evaluations(last, evals)
+                evals = []
+            last = row[0]
+            evals.append(row[1:])
+        if evals:
+            yield pack_evaluations(last, evals)
+    db.execute("create table packed_evaluations(boardid integer primary key, depth integer, scores blob, pv blob)")
+    db.executemany("insert into packed_evaluations values (?,?,?,?)", rows())
+
+def pack_evaluations(boardid, evals):
+    """
+    Pack the (depth, score, pv) list of a board, sorted by depth,
+    into a packed_evaluations row.
+    """
+    depth, score, pv = evals[-1]
+    scores = [pack_score(score)]
+    for d, s, p in reversed(evals[:-1]):
+        if d != depth - len(scores) or len(scores) >= PACKED_DEPTHS: break
+        scores.append(pack_score(s))
+    scores.reverse()
+    return boardid, depth, struct.pack(f"<{len(scores)}i", *scores), pack_pv(pv or "")
+
+def sql_key(key):
+    """A Zobrist key as a (signed 64-bit) SQLite integer."""
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def epd_key(epd):
+    return sql_key(zobrist.epd_key(epd))
+
+def index_board_keys(db):
+    """
+    Fill the board_keys table of a database, mapping the Zobrist
+    keys of its boards to their ids, so that they can be looked up
+    without making their EPDs.
+    """
+    db.execute("create table board_keys(key integer primary key, boardid integer)")
+    db.executemany("insert or ignore into board_keys values (?,?)",
+        ((epd_key(epd), boardid) for boardid, epd in db.execute("select id, epd from boards")))
 
 class BookDB:
     def __init__(self, filename):
         self.db = None
         self.db = sqlite3.connect(f"file:{filename}?immutable=1", uri=True, check_same_thread=False)
+        self.packed = self.db.execute("select count(*) from sqlite_master where name='packed_evaluations'").fetchone()[0] > 0
+        self.keyed = self.db.execute("select count(*) from sqlite_master where name='board_keys'").fetchone()[0] > 0
 
     def __enter__(self):
         return self
@@ -19,12 +115,28 @@ class BookDB:
         if self.db:
             self.db.close()
 
+    def position(self, board, key=None):
+        """
+        The position of a board for the lookups: its Zobrist key
+        (which can be passed if known), or its EPD if the book has
+        no board_keys table.
+        """
+        if not self.keyed:
+            return board.epd()
+        return sql_key(key if key is not None else zobrist.key(board))
+
+    def _boardid(self, position):
+        """The subquery of the board id of a position."""
+        if isinstance(position, int):
+            return "(select boardid from board_keys where key=?)"
+        return "(select id from boards where epd=?)"
+
     def available_ratings(self):
         return [elo for elo, in self.db.execute("select distinct elo from moves")]
 
-    def moves(self, epd, elo):
+    def moves(self, position, elo):
         movestring = None
-        for row in self.db.execute("select moves from moves where elo=? and boardid=(select id from boards where epd=?)", (elo, epd)):
+        for row in self.db.execute(f"select moves from moves where elo=? and boardid={self._boardid(position)}", (elo, position)):
             movestring, = row
         if movestring is None:
             return [], []
@@ -36,14 +148,21 @@ class BookDB:
             counts.append(int(count))
         return moves, counts
 
-    def random_move(self, epd, elo):
-        moves, counts = self.moves(epd, elo)
+    def random_move(self, position, elo):
+        moves, counts = self.moves(position, elo)
         if moves == []:
             return None
         return random.choices(moves, weights=counts)[0]
 
-    def evaluations(self, epd):
-        for depth, score, pv in self.db.execute("select depth,score,pv from evaluations where boardid=(select id from boards where epd=?)", (epd,)):
+    def evaluations(self, position):
+        if self.packed:
+            for depth, scores, pv in self.db.execute(f"select depth,scores,pv from packed_evaluations where boardid={self._boardid(position)}", (position,)):
+                scores = [s for s, in struct.iter_unpack("<i", scores)]
+                for i, score in enumerate(scores):
+                    d = depth - len(scores) + 1 + i
+                    yield d, unpack_score(score), unpack_pv(pv) if d == depth else None
+            return
+        for depth, score, pv in self.db.execute(f"select depth,score,pv from evaluations where boardid={self._boardid(position)}", (position,)):
             yield depth, score, pv
 
 default = None
@@ -53,8 +172,8 @@ def of_spec(spec):
     assert spec["type"] == "builtin"
     assert default is not None
     rating = spec["rating"]
-    return lambda board: default.random_move(board.epd(), rating)
+    return lambda board: default.random_move(default.position(board), rating)
 
 def evaldb():
     assert default is not None
-    return lambda board: list(default.evaluations(board.epd()))
+    return lambda board: list(default.evaluations(default.position(board)))
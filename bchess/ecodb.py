@@ -1,6 +1,8 @@
 # ECO classification of openings. Extracted from [1].
 # [1] https://github.com/niklasf/eco
 
+from . import zobrist
+
 db = {
  '1nbqkb1r/1ppp1ppp/4pn2/1P6/8/8/2PPPPPP/BN1QKBNR b Kk -': 'A00:Polish Opening:Rooks Swap Line',
  '1r1qkbnr/pppnpppp/3p4/8/2PP2b1/1Q3N2/PP2PPPP/RNB1KB1R w KQk -': 'A41:Zukertort Opening:Wade Defense, Chigorin Plan',
@@ -3403,3 +3405,12 @@ db = {
  'rnq1kb1r/pp3ppp/4pn2/3p1b2/3P4/NQ2PN2/PP1B1PPP/R3KB1R b KQkq -': "D12:Queen's Gambit Declined:Slav, Landau Variation",
  'rqb1kbnr/1p1p1ppp/pBn1p3/1N6/4P3/2N5/PPP2PPP/R2QKB1R b KQkq -': 'B47:Sicilian Defense:Paulsen Variation, Bastrikov Variation, Ponomariov Gambit'
 }
+
+_by_key = None
+
+def by_key():
+    """The db, by the Zobrist keys of the positions; built on first use."""
+    global _by_key
+    if _by_key is None:
+        _by_key = {zobrist.epd_key(epd): name for epd, name in db.items()}
+    return _by_key
@@ -1,9 +1,16 @@
+import chess
+import chess.syzygy
+import collections
+import json
 import math
+import os
+import socket
 import subprocess
 import threading
 import random
 
 from . import book
+from . import zobrist
 
 from collections import namedtuple
 
@@ -29,6 +36,14 @@ def score_eval(score, depth=None):
     else:
         raise ValueError("Not a valid score: {score}")
 
+def score_string(score):
+    if isinstance(score, Score_CentiPawn):
+        return f"cp {score.value}"
+    elif isinstance(score, Score_Mate):
+        return f"mate {score.moves}"
+    else:
+        raise ValueError(f"Not a valid score: {score}")
+
 def score_winpercent(score):
     if isinstance(score, Score_CentiPawn):
         return 1/(1 + 10**(-score.value/400))
@@ -47,21 +62,164 @@ def score_of_string(score):
         return Score_Mate(int(score[5:]))
     raise ValueError("Bad score format: " + repr(score))
 
+def root_fen(board):
+    """The FEN a board started from, or None for the standard start."""
+    fen = board.root().fen()
+    return None if fen == chess.STARTING_FEN else fen
+
+def uci_position(board):
+    """The arguments of the UCI "position" command for a board."""
+    fen = root_fen(board)
+    moves = " ".join(move.uci() for move in board.move_stack)
+    return f"fen {fen} moves {moves}" if fen else f"startpos moves {moves}"
+
+def analyze_evaldb(evaldb, board, callback, *args):
+    """
+    Report the evaluations of a board from evaldb, if there are
+    any, and return True; otherwise return False.
+    """
+    if not evaldb: return False
+    evals = evaldb(board)
+    if not evals: return False
+    bestmove = None
+    for depth, score, pv in evals:
+        if pv:
+            pv = pv.split()
+            bestmove = pv[0]
+        else:
+            pv = []
+        callback(Evaluation(score_of_string(score), None, depth, None, 1, pv), *args)
+    assert(bestmove is not None)
+    callback(BestMove(bestmove), *args)
+    return True
+
+# Tablebase results are exact; they are reported as searches this
+# deep, and with this score for a win.
+TABLEBASE_DEPTH = 100
+TABLEBASE_WIN = 20000
+# Probe results kept in the cache of a tablebase.
+TABLEBASE_CACHE_SIZE = 100000
+
+class Tablebase:
+    """
+    Syzygy tablebases (via chess.syzygy) from one or more
+    directories (separated by os.pathsep), with a cache of the
+    probe results. The tables are read outside of the lock of the
+    cache (chess.syzygy has its own), so that concurrent probes
+    don't wait for each other.
+    """
+
+    def __init__(self, path, cache_size=TABLEBASE_CACHE_SIZE):
+        self.path = path
+        self.tb = chess.syzygy.Tablebase()
+        for directory in path.split(os.pathsep):
+            self.tb.add_directory(directory)
+        self.max_pieces = max(
+            (len(name) - 1 for name in list(self.tb.wdl) + list(self.tb.dtz)),
+            default=0)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def probe(self, board):
+        """
+        Return (wdl, dtz) of a board for the side to move, or None
+        if it is not in the tablebases.
+        """
+        if chess.popcount(board.occupied) > self.max_pieces or board.castling_rights:
+            return None
+        key = zobrist.key(board)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        try:
+            result = (self.tb.probe_wdl(board), self.tb.probe_dtz(board))
+        except KeyError:
+            # chess.syzygy.MissingTableError
+            result = None
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def best_move(self, board):
+        """
+        Return (move, wdl) for the side to move: the move that
+        keeps the best result, and then the fastest win or the
+        slowest loss by DTZ; or None if the board is not in the
+        tablebases, or has no legal moves. (The draw rules that
+        depend on the game are left to the caller: checking them
+        here would replay the game at every probe.)
+        """
+        if self.probe(board) is None:
+            return None
+        best = None
+        for move in board.legal_moves:
+            board.push(move)
+            try:
+                result = (-2, 0) if board.is_checkmate() else self.probe(board)
+            finally:
+                board.pop()
+            if result is None:
+                return None
+            wdl, dtz = result
+            if best is None or (-wdl, dtz) > best[0]:
+                best = ((-wdl, dtz), move)
+        if best is None:
+            return None
+        return best[1].uci(), best[0][0]
+
+# Syzygy path -> Tablebase, shared by all the engines.
+tablebases = {}
+
+def tablebase(path):
+    if path not in tablebases:
+        tablebases[path] = Tablebase(path)
+    return tablebases[path]
+
+def analyze_tablebase(tb, board, callback, *args):
+    """
+    Report the tablebase evaluation of a board, if it is in the
+    tablebases, and return True; otherwise return False.
+    """
+    if not tb: return False
+    result = tb.best_move(board)
+    if result is None: return False
+    move, wdl = result
+    if wdl == 2:
+        score, wdls = Score_CentiPawn(TABLEBASE_WIN), (1000, 0, 0)
+    elif wdl == -2:
+        score, wdls = Score_CentiPawn(-TABLEBASE_WIN), (0, 0, 1000)
+    else:
+        # Cursed wins and blessed losses are draws by the 50-move rule.
+        score, wdls = Score_CentiPawn(0), (0, 1000, 0)
+    if not board.turn:
+        score, wdls = score.invert(), wdls[::-1]
+    callback(Evaluation(score, wdls, TABLEBASE_DEPTH, 0, 1, [move]), *args)
+    callback(BestMove(move), *args)
+    return True
+
 class Engine:
-    def __init__(self, exepath, options={}, maxdepth=None, maxtime=None, maxnodes=None, evaldb=None):
+    def __init__(self, exepath, options={}, maxdepth=None, maxtime=None, maxnodes=None, evaldb=None, tablebase=None):
         self.maxdepth = maxdepth
         self.maxtime = maxtime
         self.maxnodes = maxnodes
         self.exepath = exepath
         self.ucioptions = options
         self.evaldb = evaldb
+        self.tablebase = tablebase
         self.quit_requested = False
         self.request = None
+        self.stop_requested = False
         self.sent_requests = []
         self.writer_cond = threading.Condition()
         self.writer_thread = threading.Thread(target=self._writer, name="an-writer", daemon=True)
         self.reader_thread = threading.Thread(target=self._reader, name="an-reader", daemon=True)
         self.id = {}
+        # Set when the engine is ready (and has told its id).
+        self.ready = threading.Event()
         self.process = subprocess.Popen(
                 exepath,
                 encoding="utf-8",
@@ -85,21 +243,11 @@ class Engine:
         self.quit()
 
     def analyze(self, board, callback, *args):
-        if self.evaldb:
-            evals = self.evaldb(board)
-            if evals:
-                bestmove = None
-                for depth, score, pv in evals:
-                    if pv:
-                        pv = pv.split()
-                        bestmove = pv[0]
-                    else:
-                        pv = []
-                    callback(Evaluation(score_of_string(score), None, depth, None, 1, pv), *args)
-                assert(bestmove is not None)
-                callback(BestMove(bestmove), *args)
-                return
-        position = "startpos moves " + " ".join(move.uci() for move in board.move_stack)
+        if analyze_evaldb(self.evaldb, board, callback, *args):
+            return
+        if analyze_tablebase(self.tablebase, board, callback, *args):
+            return
+        position = uci_position(board)
         limit = f"nodes {self.maxnodes}" if self.maxnodes is not None else \
                 f"movetime {int(self.maxtime*1000)}" if self.maxtime is not None else \
                 f"depth {self.maxdepth}" if self.maxdepth is not None else \
@@ -108,6 +256,13 @@ class Engine:
             self.request = Request_Analyze(position, board.turn, limit, callback, args)
             self.writer_cond.notify()
 
+    def stop(self):
+        # A flag rather than a request, so that an analysis not
+        # yet sent is still sent (and answered with a bestmove).
+        with self.writer_cond:
+            self.stop_requested = True
+            self.writer_cond.notify()
+
     def play(self, board, callback, *args):
         self.analyze(board, self._play_callback, callback, *args)
 
@@ -123,17 +278,22 @@ class Engine:
         f.write("isready\n")
         while True:
             with self.writer_cond:
-                while self.request is None:
+                while self.request is None and not self.stop_requested:
                     self.writer_cond.wait()
                 req = self.request
+                stop = self.stop_requested
                 self.request = None
-                self.sent_requests.append(req)
+                self.stop_requested = False
+                if req is not None:
+                    self.sent_requests.append(req)
             if isinstance(req, Request_Quit):
                 f.close()
                 #f.write("stop\nisready\nquit\n")
                 break
             if isinstance(req, Request_Analyze):
                 f.write(f"stop\nposition {req.position}\ngo {req.limit}\n")
+            if stop:
+                f.write("stop\n")
 
     def _reader(self):
         for line in self.process.stdout:
@@ -182,11 +342,13 @@ class Engine:
                 # real.
                 self.sent_requests.pop(0)
             elif words[0] == "readyok":
-                pass
+                self.ready.set()
             elif words[0] == "id":
                 self.id[words[1]] = " ".join(words[2:])
             if isinstance(self.request, Request_Quit):
                 break
+        # Don't keep anyone waiting for an engine that is gone.
+        self.ready.set()
 
 class LossyEngine:
     def __init__(self, engine, maxloss=90):
@@ -230,16 +392,239 @@ class LossyEngine:
             callback(x.uci, *args)
         elif isinstance(x, Evaluation):
             #print(f"Eval[{fen}, {turn}] = {x}")
+            # The shallower evaluations of a packed evaldb have no PV.
+            if not x.pv: return
             move = x.pv[0]
             self.multipv[x.multipv] = (x.score if turn else x.score.invert(), move)
 
-def of_spec(spec):
-    eng = Engine(exepath=spec["bin"],
+# Seconds to wait for bchess-engined to open an engine (longer than
+# it waits for the engine to be ready, engined.READY_TIMEOUT) before
+# going on with a local one.
+OPEN_TIMEOUT = 15
+
+class DaemonClient:
+    """
+    A connection to bchess-engined (see engined.py), shared by
+    all the RemoteEngines of this process. Messages are JSON
+    objects, one per line. If the daemon goes away, its engines
+    go on as local ones.
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile("r", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.next_handle = 1
+        self.closed = False
+        self.reader_thread = threading.Thread(target=self._reader, name="engined-reader", daemon=True)
+        self.reader_thread.start()
+
+    @staticmethod
+    def connect(path):
+        """Return a DaemonClient, or None if the daemon is not running."""
+        try:
+            return DaemonClient(path)
+        except OSError:
+            return None
+
+    def send(self, msg):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        with self.lock:
+            self.sock.sendall(data)
+
+    def open(self, spec, evaldb=None, tablebase=None):
+        """
+        Return a RemoteEngine for a spec, or None if the daemon is
+        gone. The engine is opened in the background, without
+        waiting for the daemon: its requests are sent meanwhile,
+        and if the daemon refuses to run it (or takes more than
+        OPEN_TIMEOUT), it goes on as a local engine.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            handle = self.next_handle
+            self.next_handle += 1
+            eng = RemoteEngine(self, handle, spec, {}, evaldb, tablebase)
+            self.engines[handle] = eng
+        try:
+            self.send({"op": "open", "handle": handle, "spec": daemon_spec(spec)})
+        except OSError:
+            self.engines.pop(handle, None)
+            return None
+        eng.open_timer.start()
+        return eng
+
+    def close(self):
+        """Disconnect, without falling back to local engines."""
+        with self.lock:
+            self.closed = True
+            self.engines.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _reader(self):
+        try:
+            for line in self.rfile:
+                msg = json.loads(line)
+                eng = self.engines.get(msg.get("handle", None), None)
+                if eng is None:
+                    continue
+                if msg.get("op", None) == "open":
+                    eng._opened(msg)
+                else:
+                    eng._message(msg)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.closed = True
+            engines = list(self.engines.values())
+            self.engines.clear()
+        for eng in engines:
+            eng._fall_back()
+
+class RemoteEngine:
+    """
+    An Engine running in bchess-engined, with the same analyze(),
+    play(), and quit() interface; a local Engine when the daemon
+    is gone.
+    """
+
+    def __init__(self, client, handle, spec, id, evaldb=None, tablebase=None):
+        self.client = client
+        self.handle = handle
+        self.spec = spec
+        self.exepath = spec["bin"]
+        self.id = id
+        self.evaldb = evaldb
+        self.tablebase = tablebase
+        # request -> (board, callback, args), until answered
+        self.requests = {}
+        self.next_request = 1
+        self.local = None
+        self.lock = threading.Lock()
+        # Until the daemon answers the open.
+        self.open_timer = threading.Timer(OPEN_TIMEOUT, self._open_timeout)
+        self.open_timer.daemon = True
+
+    def analyze(self, board, callback, *args):
+        if analyze_evaldb(self.evaldb, board, callback, *args):
+            return
+        if analyze_tablebase(self.tablebase, board, callback, *args):
+            return
+        with self.lock:
+            local = self.local
+            if local is None:
+                req = self.next_request
+                self.next_request += 1
+                self.requests[req] = (board.copy(), callback, args)
+                try:
+                    self.client.send({"op": "analyze", "handle": self.handle, "request": req,
+                        "fen": root_fen(board), "moves": [move.uci() for move in board.move_stack]})
+                except OSError:
+                    # The reader sees the daemon gone, and falls back.
+                    pass
+                return
+        local.analyze(board, callback, *args)
+
+    def play(self, board, callback, *args):
+        self.analyze(board, self._play_callback, callback, *args)
+
+    def _play_callback(self, result, callback, *args):
+        if isinstance(result, BestMove):
+            callback(result.uci, *args)
+
+    def quit(self):
+        self.open_timer.cancel()
+        self.client.engines.pop(self.handle, None)
+        with self.lock:
+            self.requests.clear()
+            local = self.local
+        if local is not None:
+            local.quit()
+            return
+        try:
+            self.client.send({"op": "close", "handle": self.handle})
+        except OSError:
+            pass
+
+    def _opened(self, msg):
+        self.open_timer.cancel()
+        if "error" in msg:
+            # The daemon ignores the requests of the handle.
+            self.client.engines.pop(self.handle, None)
+            self._fall_back()
+        else:
+            self.id.update(msg.get("id", {}))
+
+    def _open_timeout(self):
+        if self.client.engines.pop(self.handle, None) is None:
+            return
+        # Don't leave the engine to the daemon.
+        try:
+            self.client.send({"op": "close", "handle": self.handle})
+        except OSError:
+            pass
+        self._fall_back()
+
+    def _fall_back(self):
+        """
+        Go on with a local engine, which gets the last request
+        still unanswered (as a new one stops the older ones).
+        """
+        with self.lock:
+            self.local = local_engine(self.spec, self.evaldb, self.tablebase)
+            pending = list(self.requests.values())
+            self.requests.clear()
+        if pending:
+            board, callback, args = pending[-1]
+            self.local.analyze(board, callback, *args)
+
+    def _message(self, msg):
+        req = msg["request"]
+        with self.lock:
+            if req not in self.requests: return
+            board, callback, args = self.requests[req]
+            if "eval" not in msg:
+                del self.requests[req]
+        if "eval" in msg:
+            score, wdl, depth, nodes, multipv, pv = msg["eval"]
+            callback(Evaluation(score_of_string(score), tuple(wdl) if wdl else None, depth, nodes, multipv, pv), *args)
+        elif "bestmove" in msg:
+            callback(BestMove(msg["bestmove"]), *args)
+
+def daemon_spec(spec):
+    """
+    The part of an engine spec that bchess-engined runs; the
+    rest (e.g. eval_book, syzygy, or maxloss) is applied by the
+    client.
+    """
+    return {key: spec[key] for key in ("bin", "options", "limit")}
+
+# A DaemonClient; if set, engines are run by bchess-engined when
+# it agrees to.
+daemon = None
+
+def local_engine(spec, evaldb=None, tablebase=None):
+    return Engine(exepath=spec["bin"],
             options=spec["options"],
             maxnodes=spec["limit"].get("maxnodes", None),
             maxdepth=spec["limit"].get("maxdepth", None),
             maxtime=spec["limit"].get("maxtime", None),
-            evaldb=book.evaldb() if spec.get("eval_book", False) else None)
+            evaldb=evaldb,
+            tablebase=tablebase)
+
+def of_spec(spec):
+    evaldb = book.evaldb() if spec.get("eval_book", False) else None
+    tb = tablebase(spec["syzygy"]) if spec.get("syzygy", "") else None
+    eng = daemon.open(spec, evaldb, tb) if daemon is not None else None
+    if eng is None:
+        eng = local_engine(spec, evaldb, tb)
     if "maxloss" in spec:
         eng = LossyEngine(eng, spec["maxloss"])
     return eng
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+bchess-engined: a daemon that runs the chess engines for all the
+bchess sessions of a user, so that they share a few warm engine
+processes (with their NN weights and hash tables loaded), fairly,
+and the evaluations already computed.
+
+Sessions use it if engined_socket in bchess.conf is set, e.g. to
+"{run}/bchess-engined.sock" (in $XDG_RUNTIME_DIR, or ~/.bchess),
+where the daemon listens by default; only the user can connect.
+They talk JSON, one object per line:
+
+    -> {"op": "open", "handle": H, "spec": {"bin": ..., "options": ..., "limit": ...}}
+    <- {"op": "open", "handle": H, "id": {...}}  (or "error": "...")
+    -> {"op": "analyze", "handle": H, "request": R, "fen": F, "moves": ["e2e4", ...]}
+    <- {"handle": H, "request": R, "eval": [score, wdl, depth, nodes, multipv, pv]} ...
+    <- {"handle": H, "request": R, "bestmove": "e7e5"}
+    <- {"handle": H, "request": R, "dropped": true}
+    -> {"op": "close", "handle": H}
+
+As with a local engine, a new analyze request stops the previous
+one of the same handle, which is still answered with a bestmove
+(but one that is still waiting for an engine is dropped, and
+answered with "dropped"). The moves are played from the FEN, or
+from the standard start if it is null or missing. Only the
+engines configured in the daemon's own bchess.conf are run.
+"""
+
+import argparse
+import collections
+import json
+import os
+import socketserver
+import threading
+import chess
+
+from . import bchess
+from . import engine
+
+# Engines running per spec, at most.
+MAX_ENGINES = os.cpu_count() or 1
+# Completed analyses kept in the cache.
+CACHE_SIZE = 10000
+# Where to listen if "engined_socket" is not set.
+DEFAULT_SOCKET = bchess.config_subs("{run}/bchess-engined.sock")
+# Seconds to wait for a new engine to tell its id.
+READY_TIMEOUT = 10
+
+Job = collections.namedtuple("Job", "session handle request key fen moves")
+
+def spec_key(spec):
+    return json.dumps(engine.daemon_spec(spec), sort_keys=True)
+
+class EnginePool:
+    """
+    The engines, by spec, shared by all the sessions, and a cache
+    of completed analyses, by spec and position.
+
+    Engines are not owned by sessions: each analyze request is a
+    job that runs on any free engine of its spec. At most
+    max_engines of them are started per spec; when all are busy,
+    jobs wait in per-session queues that are served round-robin,
+    so a session that keeps the engines busy can't starve the
+    others.
+    """
+
+    def __init__(self, specs, max_engines=MAX_ENGINES, cache_size=CACHE_SIZE):
+        self.specs = {spec_key(spec): spec for spec in specs}
+        self.max_engines = max_engines
+        self.cache_size = cache_size
+        self.engines = collections.defaultdict(list)
+        self.free = collections.defaultdict(list)
+        # spec key -> session -> deque of waiting jobs
+        self.waiting = collections.defaultdict(collections.OrderedDict)
+        # (session, handle) -> [job, engine, stopped]
+        self.running = {}
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _new_engine(self, key):
+        eng = engine.local_engine(self.specs[key])
+        self.engines[key].append(eng)
+        return eng
+
+    def warm(self, key):
+        """
+        Start an engine for a spec key if none is running, and
+        return one of its engines (which may not be ready yet);
+        KeyError if the key is unknown.
+        """
+        self.specs[key]
+        with self.lock:
+            if not self.engines[key]:
+                self.free[key].append(self._new_engine(key))
+            return self.engines[key][0]
+
+    def submit(self, job):
+        """
+        Run a job (or queue it), stopping the previous job of the
+        same handle.
+        """
+        with self.lock:
+            dropped = self._cancel(job.session, job.handle)
+            if self.free[job.key]:
+                eng = self.free[job.key].pop()
+            elif len(self.engines[job.key]) < self.max_engines:
+                eng = self._new_engine(job.key)
+            else:
+                eng = None
+                self.waiting[job.key].setdefault(job.session, collections.deque()).append(job)
+            if eng is not None:
+                self.running[job.session, job.handle] = [job, eng, False]
+        self._dropped(dropped)
+        if eng is not None:
+            self._start(eng, job)
+
+    def cancel(self, session, handle):
+        """Drop the waiting job of a handle, and stop its running one."""
+        with self.lock:
+            dropped = self._cancel(session, handle)
+        self._dropped(dropped)
+
+    def _cancel(self, session, handle):
+        """Return the waiting jobs that were dropped."""
+        dropped = []
+        for key, queues in self.waiting.items():
+            jobs = queues.get(session, None)
+            if jobs:
+                dropped.extend(job for job in jobs if job.handle == handle)
+                queues[session] = collections.deque(job for job in jobs if job.handle != handle)
+        running = self.running.get((session, handle), None)
+        if running is not None and not running[2]:
+            running[2] = True
+            running[1].stop()
+        return dropped
+
+    def _dropped(self, jobs):
+        # Outside of the lock: sending may block.
+        for job in jobs:
+            job.session.send({"handle": job.handle, "request": job.request, "dropped": True})
+
+    def _start(self, eng, job):
+        board = chess.Board(job.fen) if job.fen else chess.Board()
+        for move in job.moves:
+            board.push_uci(move)
+        eng.analyze(board, self._callback, eng, job, [])
+
+    def _callback(self, result, eng, job, evals):
+        if isinstance(result, engine.Evaluation):
+            ev = [engine.score_string(result.score), result.wdl, result.depth, result.nodes, result.multipv, result.pv]
+            evals.append(ev)
+            job.session.send({"handle": job.handle, "request": job.request, "eval": ev})
+        elif isinstance(result, engine.BestMove):
+            with self.lock:
+                running = self.running.get((job.session, job.handle), None)
+                if running is not None and running[0] is job:
+                    del self.running[job.session, job.handle]
+                    # Only searches that were not stopped are complete.
+                    if not running[2]:
+                        self._store(job.key, (job.fen, job.moves), (evals, result.uci))
+                nextjob = self._next(job.key)
+                if nextjob is None:
+                    self.free[job.key].append(eng)
+                else:
+                    self.running[nextjob.session, nextjob.handle] = [nextjob, eng, False]
+            job.session.send({"handle": job.handle, "request": job.request, "bestmove": result.uci})
+            if nextjob is not None:
+                self._start(eng, nextjob)
+
+    def _next(self, key):
+        queues = self.waiting[key]
+        for session in list(queues):
+            jobs = queues[session]
+            if not jobs:
+                del queues[session]
+                continue
+            job = jobs.popleft()
+            queues.move_to_end(session)
+            return job
+        return None
+
+    def cached(self, key, position):
+        """The cached analysis of a (fen, moves) position, or None."""
+        with self.lock:
+            result = self.cache.get((key, position), None)
+            if result is not None:
+                self.cache.move_to_end((key, position))
+            return result
+
+    def _store(self, key, position, result):
+        self.cache[key, position] = result
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def quit(self):
+        with self.lock:
+            for engines in self.engines.values():
+                for eng in engines:
+                    eng.quit()
+            self.engines.clear()
+            self.free.clear()
+
+class Session(socketserver.StreamRequestHandler):
+    """
+    One connected bchess process, with its open handles.
+    """
+
+    def setup(self):
+        super().setup()
+        self.pool = self.server.pool
+        self.lock = threading.Lock()
+        # handle -> spec key
+        self.handles = {}
+
+    def send(self, msg):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        try:
+            with self.lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+        except (OSError, ValueError):
+            # The session is gone; handle() cleans up.
+            pass
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                msg = json.loads(line)
+                op = msg.get("op", None)
+                if op == "open": self.op_open(msg)
+                elif op == "analyze": self.op_analyze(msg)
+                elif op == "close": self.op_close(msg)
+        finally:
+            for handle in list(self.handles):
+                self.op_close({"handle": handle})
+
+    def op_open(self, msg):
+        handle = msg["handle"]
+        key = spec_key(msg["spec"])
+        try:
+            eng = self.pool.warm(key)
+        except KeyError:
+            self.send({"op": "open", "handle": handle, "error": "unknown engine"})
+            return
+        except OSError as e:
+            self.send({"op": "open", "handle": handle, "error": str(e)})
+            return
+        # The handle takes requests at once (they wait in the
+        # engine's input); the reply, with the id, waits for the
+        # engine in another thread, not to hold up the requests of
+        # the other handles while the engine loads.
+        self.handles[handle] = key
+        threading.Thread(target=self._opened, args=(handle, eng), name="engined-open", daemon=True).start()
+
+    def _opened(self, handle, eng):
+        eng.ready.wait(READY_TIMEOUT)
+        self.send({"op": "open", "handle": handle, "id": dict(eng.id)})
+
+    def op_analyze(self, msg):
+        handle = msg["handle"]
+        if handle not in self.handles: return
+        key = self.handles[handle]
+        req = msg["request"]
+        fen = msg.get("fen", None)
+        moves = tuple(msg["moves"])
+        result = self.pool.cached(key, (fen, moves))
+        if result is not None:
+            self.pool.cancel(self, handle)
+            evals, bestmove = result
+            for ev in evals:
+                self.send({"handle": handle, "request": req, "eval": ev})
+            self.send({"handle": handle, "request": req, "bestmove": bestmove})
+            return
+        self.pool.submit(Job(self, handle, req, key, fen, moves))
+
+    def op_close(self, msg):
+        if self.handles.pop(msg["handle"], None) is not None:
+            self.pool.cancel(self, msg["handle"])
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    config = bchess.default_config()
+    parser = argparse.ArgumentParser(description="Run chess engines for bchess sessions.")
+    parser.add_argument("--socket", default=config.get("engined_socket", "") or DEFAULT_SOCKET, help="the Unix socket to listen on")
+    parser.add_argument("--max-engines", type=int, default=MAX_ENGINES, help="engines to run per engine type, at most")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="analyses to keep in the cache")
+    args = parser.parse_args()
+    specs = list(config["ai"].values())
+    if config.get("eval_ai"):
+        specs.append(config["eval_ai"])
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), mode=0o700, exist_ok=True)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    # Only this user's sessions may connect: the engines run on
+    # their behalf.
+    umask = os.umask(0o177)
+    try:
+        server = Server(args.socket, Session)
+    finally:
+        os.umask(umask)
+    server.pool = EnginePool(specs, args.max_engines, args.cache_size)
+    print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.quit()
+        os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import curses
+import time
 
-from contextlib import contextmanager
-from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from collections import namedtuple, deque
 
 EventMousePress = namedtuple("EventMousePress", "button x y")
+EventMouseRelease = namedtuple("EventMouseRelease", "button x y")
 
 class Ref:
     """
@@ -57,6 +59,117 @@ class IM_EndOfScreen(Exception):
     """
     pass
 
+class Profiler:
+    """
+    Frame time statistics of named IM regions.
+
+    For each frame the total time spent in every region is
+    recorded; the last nframes of these are kept to compute
+    the percentiles. Regions are timed inclusively, so e.g.
+    "Table" includes the time of all its "Cell"s; a region
+    nested in one of the same name (e.g. a table in a cell of
+    a table) is not counted again.
+    """
+
+    def __init__(self, nframes=1000):
+        self.nframes = nframes
+        self.samples = {}
+        self.current = {}
+        self.open = set()
+
+    @contextmanager
+    def region(self, name):
+        """Time a region, unless it is inside one of the same name."""
+        if name in self.open:
+            yield
+            return
+        self.open.add(name)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.open.discard(name)
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name, seconds):
+        """Add time spent in a region during the current frame."""
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def end_frame(self):
+        for name, seconds in self.current.items():
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.nframes)
+            self.samples[name].append(seconds)
+        self.current = {}
+
+    def stats(self):
+        """
+        Return a list of (name, frames, p50, p99, max) tuples,
+        with times in seconds, slowest regions first.
+        """
+        result = []
+        for name, samples in self.samples.items():
+            s = sorted(samples)
+            n = len(s)
+            result.append((name, n, s[n//2], s[min(n*99//100, n-1)], s[-1]))
+        result.sort(key=lambda r: -r[3])
+        return result
+
+    def format(self):
+        """Return the statistics as a list of text lines."""
+        lines = [f"{'region':<12} {'frames':>6} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}"]
+        for name, n, p50, p99, pmax in self.stats():
+            lines.append(f"{name[:12]:<12} {n:6} {p50*1000:7.2f} {p99*1000:7.2f} {pmax*1000:7.2f}")
+        return lines
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            for line in self.format():
+                f.write(line + "\n")
+
+class VirtualScreen:
+    """
+    An in-memory stand-in for a curses window, implementing only
+    the methods IM uses. Useful for rendering frames without a
+    terminal, e.g. in benchmarks, or for terminals curses does
+    not drive (see server.py). Keeps the attribute of each cell
+    next to its character.
+    """
+
+    def __init__(self, height=24, width=80):
+        self.height = height
+        self.width = width
+        self.nrefresh = 0
+        self.erase()
+
+    def erase(self):
+        self.lines = [[" "] * self.width for y in range(self.height)]
+        self.attrs = [[0] * self.width for y in range(self.height)]
+
+    def addstr(self, y, x, text, attr=0):
+        """
+        Same as curses' addstr(), including the failure when the
+        text does not fit, or ends in the lower right corner.
+        """
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            raise curses.error("addstr() returned ERR")
+        n = min(len(text), self.width - x)
+        self.lines[y][x:x + n] = text[:n]
+        self.attrs[y][x:x + n] = [attr] * n
+        if x + len(text) > self.width or \
+                (y == self.height - 1 and x + len(text) == self.width):
+            raise curses.error("addstr() returned ERR")
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def refresh(self):
+        self.nrefresh += 1
+
+    def text(self):
+        """Return the screen contents as a string."""
+        return "\n".join("".join(line).rstrip() for line in self.lines)
+
 class IM:
     """
     This is an "immediate mode" terminal UI library.
@@ -68,9 +181,16 @@ class IM:
 
     def __init__(self):
         self.win = None
-        self.key_events = []
+        self.key_events = deque()
+        self.key_counts = {}
         self.mouse_events = []
+        self.mouse_rects = {}
+        self.mouse_hits = {}
         self.want_refresh = False
+        self.max_fps = 30
+        self.profiler = None
+        self.frame_time = 0.0
+        self.dirty = False
         self.minx = 0
         self.miny = 0
         self.maxx = 0
@@ -109,7 +229,29 @@ class IM:
             rq = self.runqueue
             self.runqueue = []
             for f in rq: f()
-        return self.key_events != [] or self.mouse_events != []
+        return bool(self.key_counts) or self.mouse_events != []
+
+    def invalidate(self):
+        """
+        Mark the screen as out of date, without forcing an
+        immediate refresh. All invalidations that arrive between
+        two frames are merged into one, and the frames are paced
+        to at most max_fps per second. Use this for updates coming
+        from background threads; user input should set
+        want_refresh instead, which bypasses the pacing.
+        """
+        self.dirty = True
+
+    def frame_due(self):
+        """
+        Return True if the next frame should be rendered now:
+        either a refresh was requested, or the screen was
+        invalidated and the frame rate limit allows a new frame.
+        """
+        if self.want_refresh: return True
+        if not self.dirty: return False
+        if not self.max_fps: return True
+        return time.monotonic() - self.frame_time >= 1/self.max_fps
 
     def run_soon(self, f):
         """Enqueue a function to be run after the next gather_input()."""
@@ -127,10 +269,25 @@ class IM:
             self.mouse_events.append(EventMousePress(4, x, y))
         if state & getattr(curses, "BUTTON5_PRESSED", 134217728):
             self.mouse_events.append(EventMousePress(5, x, y))
+        if state & curses.BUTTON1_RELEASED:
+            self.mouse_events.append(EventMouseRelease(1, x, y))
 
     def input_key(self, key):
         """Add a keyboard event to the input queue."""
         self.key_events.append(key)
+        self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+    def _pending_keys(self):
+        """
+        Remove and return all unconsumed key events, in order.
+        Key() consumes every press of a key at once, so its
+        entries in key_events are dropped lazily here: a key is
+        still pending if and only if it has a count.
+        """
+        keys = [k for k in self.key_events if k in self.key_counts]
+        self.key_events.clear()
+        self.key_counts.clear()
+        return keys
 
     @property
     def text_width(self):
@@ -148,18 +305,26 @@ class IM:
         Reset the screen state and prepare for a new frame. Call
         this each frame.
         """
+        t = time.perf_counter()
         self.win = screen
         self.win.erase()
         self.want_refresh = False
+        self.frame_time = time.monotonic()
+        self.dirty = False
+        self._mouse_resolve()
         self._focus_begin()
         try:
             with self.Screen(): yield
         finally:
             self.win.refresh()
             self.win = None
-            self.key_events = []
-            self.mouse_events = []
+            self.key_events.clear()
+            self.key_counts.clear()
+            self.mouse_hits = {}
             self._focus_end()
+            if self.profiler is not None:
+                self.profiler.add("Frame", time.perf_counter() - t)
+                self.profiler.end_frame()
 
     @contextmanager
     def Screen(self):
@@ -181,6 +346,25 @@ class IM:
         finally:
             self.minx, self.miny, self.maxy, self.maxx, self.curx, self.cury = save
 
+    @contextmanager
+    def Region(self, name):
+        """
+        A named part of the layout. Does nothing by itself, but
+        is timed if the profiler is enabled.
+        """
+        with self._profiled(name):
+            yield
+
+    def _profiled(self, name):
+        return self.profiler.region(name) if self.profiler is not None else nullcontext()
+
+    def ProfileOverlay(self, attr=curses.A_REVERSE):
+        """Show the profiler statistics over the current layout."""
+        if self.profiler is None: return
+        with self.Screen():
+            for line in self.profiler.format():
+                self.Text(line, attr=attr)
+
     def Key(self, key, id=None):
         """
         An invisible key accelerator. Returns the number of times
@@ -188,9 +372,7 @@ class IM:
         when the specified element is active.
         """
         if id is None or self.active_id == id:
-            n = len(self.key_events)
-            self.key_events = [e for e in self.key_events if e != key]
-            return n - len(self.key_events)
+            return self.key_counts.pop(key, 0)
         else:
             return 0
 
@@ -270,41 +452,90 @@ class IM:
 
     def AllKeys(self, id=None):
         if id is None or self.active_id == id:
-            for k in self.key_events: yield k
-            self.key_events = []
+            for k in self._pending_keys(): yield k
         else:
             return 0
 
     def Input(self, text, id=None, prefix="", attr=0, align=0):
         change = False
         if self.active_id == id:
-            while self.key_events:
-                key = self.key_events.pop(0)
+            # Collect the typed characters in a list, so that
+            # pasting a lot of text stays linear.
+            chars = []
+            for key in self._pending_keys():
                 if key == curses.KEY_BACKSPACE:
-                    if text == "":
+                    if chars:
+                        chars.pop()
+                        change = True
+                    elif text == "":
                         pass
                     else:
                         text = text[:-1]
                         change = True
                 elif type(key) == str:
-                    text = text + key
+                    chars.append(key)
                     change = True
+            if chars:
+                text = text + "".join(chars)
             self.Text(prefix + text + "▒", attr=attr, align=align)
         else:
             self.Text(prefix + text + " ", attr=attr, align=align)
         return text, change
 
+    def _mouse_resolve(self):
+        """
+        Call at the start of Frame() to match the pending mouse
+        events against the clickable regions of the previous
+        frame (which is what the user saw when clicking). If
+        regions overlap, the one registered first gets the event.
+        Each region gets the positions of its events in the input,
+        so the order of e.g. a press and a release over different
+        regions is not lost.
+        """
+        rects, self.mouse_rects = self.mouse_rects, {}
+        events, self.mouse_events = self.mouse_events, []
+        self.mouse_hits = {}
+        if not events: return
+        rows = {}
+        for rect in rects:
+            x, y, w, h = rect
+            for row in range(y, y + h):
+                rows.setdefault(row, []).append(rect)
+        for i, e in enumerate(events):
+            for rect in rows.get(e.y, ()):
+                if rect[0] <= e.x < rect[0] + rect[2]:
+                    self.mouse_hits.setdefault((type(e), rect), []).append(i)
+                    break
+
     def MouseClick(self, x, y, w, h):
         """
         An invisible mouse region. Returns the number of times
         it was clicked.
         """
-        n = len(self.mouse_events)
-        self.mouse_events = [
-            e for e in self.mouse_events
-            if not((x <= e.x < x + w) and (y <= e.y < y + h))
-        ]
-        return n - len(self.mouse_events)
+        return len(self.MouseEvents(x, y, w, h, EventMousePress))
+
+    def MouseEvents(self, x, y, w, h, *types):
+        """
+        An invisible mouse region. Returns the (order, event type)
+        of the mouse events of the given types (all by default)
+        over it, sorted; the order is the position of the event
+        in the input, and is comparable across regions.
+        """
+        rect = x, y, w, h
+        self.mouse_rects[rect] = None
+        result = []
+        if self.mouse_hits:
+            for t in types or (EventMousePress, EventMouseRelease):
+                result.extend((i, t) for i in self.mouse_hits.pop((t, rect), ()))
+        return sorted(result)
+
+    def MouseRelease(self, x, y, w, h):
+        """
+        An invisible mouse region. Returns the number of times
+        the (left) mouse button was released over it, e.g. at the
+        end of a drag.
+        """
+        return len(self.MouseEvents(x, y, w, h, EventMouseRelease))
 
     def TextAt(self, x, y, text, attr=0):
         """A text label at fixed coordinates."""
@@ -365,26 +596,27 @@ class IM:
         A table with fixed column widths. Use Row() immediately
         inside, and then Cell().
         """
-        save = self.table_rowy, self.table_maxy, self.table_col_minx, self.table_col_maxx, self.table_idx
-        minx, maxx = self.minx, self.maxx
-        colw = [w if type(w) is int else w[0] for w in widths]
-        colf = [0 if type(w) is int else w[1] for w in widths]
-        self.table_rowy = self.cury
-        self.table_maxy = self.cury
-        self.table_col_minx = []
-        self.table_col_maxx = []
-        extraw = 1 + maxx - minx - sum(colw) - margin*(len(colw)-1)
-        x = minx
-        for i in range(len(colw)):
-            flex = 0 if colf[i] == 0 else (extraw * colf[i] // sum(colf))
-            self.table_col_minx.append(x)
-            self.table_col_maxx.append(min(x + colw[i] + flex - 1, maxx))
-            x += colw[i] + flex + margin
-        yield
-        self.minx, self.maxx = minx, maxx
-        self.curx = minx
-        self.cury = self.table_maxy
-        self.table_rowy, self.table_maxy, self.table_col_minx, self.table_col_maxx, self.table_idx = save
+        with self._profiled("Table"):
+            save = self.table_rowy, self.table_maxy, self.table_col_minx, self.table_col_maxx, self.table_idx
+            minx, maxx = self.minx, self.maxx
+            colw = [w if type(w) is int else w[0] for w in widths]
+            colf = [0 if type(w) is int else w[1] for w in widths]
+            self.table_rowy = self.cury
+            self.table_maxy = self.cury
+            self.table_col_minx = []
+            self.table_col_maxx = []
+            extraw = 1 + maxx - minx - sum(colw) - margin*(len(colw)-1)
+            x = minx
+            for i in range(len(colw)):
+                flex = 0 if colf[i] == 0 else (extraw * colf[i] // sum(colf))
+                self.table_col_minx.append(x)
+                self.table_col_maxx.append(min(x + colw[i] + flex - 1, maxx))
+                x += colw[i] + flex + margin
+            yield
+            self.minx, self.maxx = minx, maxx
+            self.curx = minx
+            self.cury = self.table_maxy
+            self.table_rowy, self.table_maxy, self.table_col_minx, self.table_col_maxx, self.table_idx = save
 
     @contextmanager
     def Row(self):
@@ -396,13 +628,14 @@ class IM:
 
     @contextmanager
     def Cell(self, colspan=1):
-        self.minx = self.table_col_minx[self.table_idx]
-        self.maxx = self.table_col_maxx[self.table_idx + colspan - 1]
-        self.curx = self.minx
-        self.cury = self.table_rowy
-        yield
-        self.table_maxy = max(self.table_maxy, self.cury)
-        self.table_idx += colspan
+        with self._profiled("Cell"):
+            self.minx = self.table_col_minx[self.table_idx]
+            self.maxx = self.table_col_maxx[self.table_idx + colspan - 1]
+            self.curx = self.minx
+            self.cury = self.table_rowy
+            yield
+            self.table_maxy = max(self.table_maxy, self.cury)
+            self.table_idx += colspan
 
     def RowSeparator(self, fill="-"):
         with self.Row():
@@ -0,0 +1,223 @@
+"""
+bchess serve-moves: the bchess opponents (their move sources, see
+bchess.Opponent) as a service for other programs.
+
+Requests and replies are JSON objects, one per line, on stdin and
+stdout, or on a Unix socket with --socket:
+
+    -> {"id": 1, "opponent": "Maia 1100", "moves": ["e2e4"]}
+    <- {"id": 1, "move": "c7c5", "ms": 0.3}
+    -> {"id": 2, "opponent": "Maia 1100", "fen": "...", "moves": []}
+    <- {"id": 2, "error": "..."}
+    -> {"id": 3, "op": "stats"}
+    <- {"id": 3, "stats": {"Maia 1100": {"p50_ms": 0.3, ..., "sources": {"book": {"tries": 1, ...}}}}}
+
+Requests are pipelined: many can be sent without waiting, and the
+replies come as soon as the moves are ready, not in order. Each
+opponent has a pool of up to --engines engines; the requests that
+don't find a free one wait for it.
+"""
+
+import argparse
+import collections
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import chess
+
+from . import bchess
+from . import engine
+from . import zobrist
+
+# Engines per opponent, at most.
+ENGINES = 2
+# Latencies kept per opponent for the statistics.
+STATS_SAMPLES = 10000
+
+class EnginePool:
+    """
+    The engines of an opponent behind the Engine play() interface:
+    up to max_engines of them, with the requests beyond that
+    waiting for a free one.
+    """
+
+    def __init__(self, spec, max_engines=ENGINES):
+        self.spec = spec
+        self.max_engines = max_engines
+        self.engines = []
+        self.free = []
+        self.waiting = collections.deque()
+        self.lock = threading.Lock()
+
+    def play(self, board, callback, *args):
+        with self.lock:
+            if self.free:
+                eng = self.free.pop()
+            elif len(self.engines) < self.max_engines:
+                eng = engine.of_spec(self.spec)
+                self.engines.append(eng)
+            else:
+                self.waiting.append((board, callback, args))
+                return
+        eng.play(board, self._engine_callback, eng, callback, args)
+
+    def _engine_callback(self, move, eng, callback, args):
+        with self.lock:
+            nextreq = self.waiting.popleft() if self.waiting else None
+            if nextreq is None:
+                self.free.append(eng)
+        callback(move, *args)
+        if nextreq is not None:
+            board, nextcallback, nextargs = nextreq
+            eng.play(board, self._engine_callback, eng, nextcallback, nextargs)
+
+    def quit(self):
+        for eng in self.engines:
+            eng.quit()
+
+class Opponent(bchess.Opponent):
+    """
+    A bchess.Opponent with an EnginePool, and the latencies of its
+    replies.
+    """
+
+    def __init__(self, spec, config, max_engines=ENGINES):
+        self.pool = EnginePool(spec, max_engines)
+        super().__init__(spec, self.pool, config)
+        self.latencies = collections.deque(maxlen=STATS_SAMPLES)
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def latency_stats(self):
+        with self.lock:
+            s = sorted(self.latencies)
+        n = len(s)
+        result = {"count": n}
+        if n:
+            result.update(p50_ms=round(s[n//2]*1000, 3), p99_ms=round(s[min(n*99//100, n-1)]*1000, 3), max_ms=round(s[-1]*1000, 3))
+        result["sources"] = self.source_stats()
+        return result
+
+    def quit(self):
+        self.pool.quit()
+
+class MoveServer:
+    """
+    Answers the requests; send(msg) of the connection a request
+    came from gets the reply, maybe from another thread.
+    """
+
+    def __init__(self, config, max_engines=ENGINES):
+        self.config = config
+        self.specs = {}
+        for key, spec in config["ai"].items():
+            self.specs[key] = spec
+            self.specs.setdefault(spec.get("name", key), spec)
+        self.max_engines = max_engines
+        self.opponents = {}
+        self.lock = threading.Lock()
+
+    def opponent(self, name):
+        with self.lock:
+            if name not in self.opponents:
+                self.opponents[name] = Opponent(self.specs[name], self.config, self.max_engines)
+            return self.opponents[name]
+
+    def handle(self, line, send):
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            send({"error": f"bad request: {e}"})
+            return
+        reqid = req.get("id", None)
+        if req.get("op", None) == "stats":
+            with self.lock:
+                opponents = list(self.opponents.items())
+            send({"id": reqid, "stats": {name: opp.latency_stats() for name, opp in opponents}})
+            return
+        name = req.get("opponent", None)
+        if name not in self.specs:
+            send({"id": reqid, "error": f"unknown opponent: {name!r}"})
+            return
+        try:
+            board = chess.Board(req["fen"]) if req.get("fen", None) else chess.Board()
+            tracker = zobrist.Tracker(board)
+            for move in req.get("moves", []):
+                tracker.push_uci(move)
+        except ValueError as e:
+            send({"id": reqid, "error": f"bad position: {e}"})
+            return
+        if tracker.is_game_over():
+            send({"id": reqid, "error": "the game is over"})
+            return
+        opp = self.opponent(name)
+        t = time.perf_counter()
+        try:
+            opp.play(board, self._reply, reqid, opp, t, send, tracker=tracker)
+        except ValueError as e:
+            send({"id": reqid, "error": str(e)})
+
+    def _reply(self, move, reqid, opp, t, send):
+        dt = time.perf_counter() - t
+        opp.record(dt)
+        send({"id": reqid, "move": move, "ms": round(dt*1000, 3)})
+
+    def quit(self):
+        for opp in self.opponents.values():
+            opp.quit()
+
+class Connection(socketserver.StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+        def send(msg):
+            data = (json.dumps(msg) + "\n").encode("utf-8")
+            try:
+                with lock:
+                    self.wfile.write(data)
+                    self.wfile.flush()
+            except (OSError, ValueError):
+                pass
+        for line in self.rfile:
+            if line.strip():
+                self.server.moveserver.handle(line, send)
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bchess serve-moves", description="Serve the moves of the bchess opponents.")
+    parser.add_argument("--socket", help="listen on this Unix socket instead of stdin/stdout")
+    parser.add_argument("--engines", type=int, default=ENGINES, help="engines per opponent, at most")
+    args = parser.parse_args(argv)
+    moveserver = MoveServer(bchess.default_config(), args.engines)
+    try:
+        if args.socket:
+            if os.path.exists(args.socket):
+                os.unlink(args.socket)
+            server = Server(args.socket, Connection)
+            server.moveserver = moveserver
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(args.socket)
+        else:
+            lock = threading.Lock()
+            def send(msg):
+                with lock:
+                    sys.stdout.write(json.dumps(msg) + "\n")
+                    sys.stdout.flush()
+            for line in sys.stdin:
+                if line.strip():
+                    moveserver.handle(line, send)
+            # Wait for the replies still pending.
+            while any(len(opp.pool.engines) != len(opp.pool.free) for opp in moveserver.opponents.values()):
+                time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        moveserver.quit()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+bchess-server: many bchess sessions in one process, for hosting
+bchess for many users, e.g. as a telnet-style TCP service on
+localhost, or behind an SSH forced command such as
+
+    socat STDIO,raw,echo=0 TCP:localhost:2323
+
+Each connection gets its own IM, drawn on a VirtualScreen, and
+sent to the terminal as ANSI escape sequences (only the rows that
+changed since the previous frame). The sessions share the opening
+book, the ECO data, and one engine pool (bchess-engined if it is
+running, or an EnginePool of this process otherwise). Each session
+has its own connection to the pool, which serves the connections
+round-robin, so that the engine work of the sessions is scheduled
+fairly; engines are opened in the background, so that one slow to
+load doesn't hold up the terminals.
+
+The bchess module draws on its global im, and its scene is the
+global UI_RENDERER; the server swaps both (and engine.daemon) in
+for the session it is currently working on. Engine callbacks arrive in other threads,
+so UI keeps its own im for them.
+"""
+
+import argparse
+import codecs
+import contextlib
+import curses
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+from . import bchess
+from . import book
+from . import engine
+from . import engined
+from . import imui
+
+PORT = 2323
+# The screen size of terminals that don't tell us theirs.
+DEFAULT_SIZE = (30, 80)
+# A session is dropped if its terminal doesn't take any of its
+# output for this many seconds.
+SEND_TIMEOUT = 10
+
+# Telnet commands and options.
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SGA, NAWS = 1, 3, 31
+
+# Keys sent as escape sequences: CSI/SS3 final bytes, and CSI
+# numbers followed by "~".
+ESCAPE_FINALS = {
+    "A": curses.KEY_UP, "B": curses.KEY_DOWN, "C": curses.KEY_RIGHT, "D": curses.KEY_LEFT,
+    "H": curses.KEY_HOME, "F": curses.KEY_END, "Z": curses.KEY_BTAB,
+    "P": curses.KEY_F1, "Q": curses.KEY_F2, "R": curses.KEY_F3, "S": curses.KEY_F4
+}
+ESCAPE_NUMBERS = {
+    1: curses.KEY_HOME, 2: curses.KEY_IC, 3: curses.KEY_DC, 4: curses.KEY_END,
+    5: curses.KEY_PPAGE, 6: curses.KEY_NPAGE,
+    15: curses.KEY_F5, 17: curses.KEY_F6, 18: curses.KEY_F7, 19: curses.KEY_F8,
+    20: curses.KEY_F9, 21: curses.KEY_F10, 23: curses.KEY_F11, 24: curses.KEY_F12
+}
+
+class InputParser:
+    """
+    Turn the bytes from a terminal into curses-style keys: strip
+    telnet commands (noting the window size), decode UTF-8, and
+    parse escape sequences.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.telnet = b""
+        self.text = ""
+        self.size = None
+        self.last_cr = False
+
+    def feed(self, data):
+        """Return the list of keys in the data."""
+        data = self._telnet(self.telnet + data)
+        self.text += self.decoder.decode(data)
+        keys = []
+        i = 0
+        text = self.text
+        while i < len(text):
+            c = text[i]
+            if c == "\x1b":
+                if i + 1 == len(text):
+                    # A lone escape.
+                    keys.append("\x1b")
+                    i += 1
+                    continue
+                if text[i + 1] not in "[O":
+                    keys.append("\x1b")
+                    i += 1
+                    continue
+                j = i + 2
+                while j < len(text) and not ("@" <= text[j] <= "~"):
+                    j += 1
+                if j == len(text):
+                    # The rest of the sequence comes later.
+                    break
+                params, final = text[i + 2:j], text[j]
+                if final == "~":
+                    number = params.split(";")[0]
+                    key = ESCAPE_NUMBERS.get(int(number), None) if number.isdigit() else None
+                else:
+                    key = ESCAPE_FINALS.get(final, None)
+                if key is not None:
+                    keys.append(key)
+                i = j + 1
+                continue
+            i += 1
+            # Telnet sends Enter as "\r\n" or "\r\0".
+            if self.last_cr and c in "\n\0":
+                self.last_cr = False
+                continue
+            self.last_cr = c == "\r"
+            if c in "\r\n":
+                keys.append("\n")
+            elif c in "\x7f\x08":
+                keys.append(curses.KEY_BACKSPACE)
+            else:
+                keys.append(c)
+        self.text = text[i:]
+        return keys
+
+    def _telnet(self, data):
+        out = bytearray()
+        i = 0
+        while i < len(data):
+            b = data[i]
+            if b != IAC:
+                out.append(b)
+                i += 1
+                continue
+            if i + 1 >= len(data): break
+            cmd = data[i + 1]
+            if cmd == IAC:
+                out.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data): break
+                i += 3
+            elif cmd == SB:
+                end = data.find(bytes([IAC, SE]), i)
+                if end < 0: break
+                sub = data[i + 2:end].replace(bytes([IAC, IAC]), bytes([IAC]))
+                if len(sub) >= 5 and sub[0] == NAWS:
+                    width, height = sub[1]*256 + sub[2], sub[3]*256 + sub[4]
+                    if width > 0 and height > 0:
+                        self.size = (height, width)
+                i = end + 2
+            else:
+                i += 2
+        self.telnet = bytes(data[i:])
+        return bytes(out)
+
+class AnsiColors:
+    """
+    Color pairs for config_implement_colors() that need no curses
+    terminal: pairs are numbered like curses does, and remembered
+    to be written as ANSI colors.
+    """
+
+    def __init__(self):
+        self.pairs = {0: (-1, -1)}
+
+    def init_pair(self, n, fg, bg):
+        self.pairs[n] = (fg, bg)
+
+    def color_pair(self, n):
+        return n << 8
+
+    def sgr(self, attr):
+        """The ANSI SGR sequence for a curses attribute."""
+        codes = ["0"]
+        if attr & curses.A_BOLD: codes.append("1")
+        if attr & curses.A_DIM: codes.append("2")
+        if attr & curses.A_UNDERLINE: codes.append("4")
+        if attr & curses.A_BLINK: codes.append("5")
+        if attr & (curses.A_REVERSE | curses.A_STANDOUT): codes.append("7")
+        if attr & curses.A_INVIS: codes.append("8")
+        fg, bg = self.pairs.get((attr & curses.A_COLOR) >> 8, (-1, -1))
+        if fg >= 0: codes.append(f"38;5;{fg}")
+        if bg >= 0: codes.append(f"48;5;{bg}")
+        return "\x1b[" + ";".join(codes) + "m"
+
+class TerminalSession:
+    """
+    One connected terminal, with its own IM and scene.
+
+    The socket is non-blocking: the output is queued, and sent as
+    the terminal takes it, so that a slow terminal doesn't hold
+    up the other sessions. While some of it is still queued, no
+    new frames are drawn (the next one covers what they would
+    have changed).
+    """
+
+    def __init__(self, sock, config, colors, name="guest", pgn_autosave=None, daemon=None):
+        self.sock = sock
+        self.daemon = daemon
+        self.sock.setblocking(False)
+        self.outbuf = bytearray()
+        # When the output last made progress, if some is queued.
+        self.stalled = None
+        self.colors = colors
+        self.parser = InputParser()
+        self.im = imui.IM()
+        self.im.max_fps = config.get("max_fps", self.im.max_fps)
+        self.screen = imui.VirtualScreen(*DEFAULT_SIZE)
+        self.sent = None
+        self.got_input = False
+        self.renderer = None
+        self.send(bytes([IAC, WILL, ECHO, IAC, WILL, SGA, IAC, DO, NAWS]))
+        self.send(b"\x1b[?1049h\x1b[?25l\x1b[2J")
+        config = dict(config, user_name=name, pgn_autosave=pgn_autosave)
+        with self.active():
+            bchess.set_scene(bchess.UI0(config).render)
+
+    @contextlib.contextmanager
+    def active(self):
+        """
+        Make the IM, the scene, and the engine pool connection of
+        this session the current ones.
+        """
+        bchess.im = self.im
+        bchess.UI_RENDERER = self.renderer
+        engine.daemon = self.daemon
+        try:
+            yield
+        finally:
+            self.renderer = bchess.UI_RENDERER
+
+    def send(self, data):
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        """
+        Send as much of the queued output as the terminal takes
+        now; raise OSError if it took none for SEND_TIMEOUT.
+        """
+        if not self.outbuf: return
+        try:
+            n = self.sock.send(self.outbuf)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        del self.outbuf[:n]
+        now = time.monotonic()
+        if not self.outbuf:
+            self.stalled = None
+        elif n or self.stalled is None:
+            self.stalled = now
+        elif now - self.stalled > SEND_TIMEOUT:
+            raise OSError("the terminal takes no output")
+
+    def receive(self):
+        """Read the input; return False once the terminal is gone."""
+        try:
+            data = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return True
+        if not data:
+            return False
+        for key in self.parser.feed(data):
+            self.im.input_key(key)
+            self.got_input = True
+        if self.parser.size and self.parser.size != (self.screen.height, self.screen.width):
+            self.screen = imui.VirtualScreen(*self.parser.size)
+            self.sent = None
+            self.im.want_refresh = True
+        return True
+
+    def step(self):
+        """
+        Run the pending callbacks, and draw a frame if needed.
+        Raises SystemExit when the user quits.
+        """
+        self.flush()
+        with self.active():
+            if self.im.runqueue:
+                rq = self.im.runqueue
+                self.im.runqueue = []
+                for f in rq: f()
+            if self.outbuf:
+                return
+            if not (self.got_input or self.im.want_refresh or self.im.frame_due()):
+                return
+            self.got_input = False
+            with self.im.Frame(self.screen):
+                bchess.UI_RENDERER()
+                if self.im.Key("q"):
+                    raise SystemExit
+        self.send_screen()
+
+    def send_screen(self):
+        """Send the rows that changed since the last frame."""
+        out = []
+        height, width = self.screen.height, self.screen.width
+        for y in range(height):
+            line, attrs = self.screen.lines[y], self.screen.attrs[y]
+            if self.sent is not None and self.sent[y] == (line, attrs):
+                continue
+            # Writing the lower right corner would scroll.
+            n = width - 1 if y == height - 1 else width
+            out.append(f"\x1b[{y + 1};1H")
+            attr = None
+            for x in range(n):
+                if attrs[x] != attr:
+                    attr = attrs[x]
+                    out.append(self.colors.sgr(attr))
+                out.append(line[x])
+        if out:
+            out.append("\x1b[0m")
+            self.send("".join(out).encode("utf-8"))
+        self.sent = [(list(line), list(attrs)) for line, attrs in zip(self.screen.lines, self.screen.attrs)]
+
+    def close(self):
+        with self.active():
+            scene = getattr(self.renderer, "__self__", None)
+            if hasattr(scene, "quit_engines"):
+                scene.quit_engines()
+        if self.daemon is not None:
+            self.daemon.close()
+        try:
+            # Best effort: the terminal may not take it.
+            self.sock.send(bytes(self.outbuf) + b"\x1b[0m\x1b[?25h\x1b[?1049l")
+        except OSError:
+            pass
+        self.sock.close()
+
+def start_engine_pool(config, max_engines):
+    """
+    Run an EnginePool in this process, behind a private socket
+    (its server_address) for the sessions to connect to.
+    """
+    specs = list(config["ai"].values())
+    if config.get("eval_ai"):
+        specs.append(config["eval_ai"])
+    path = os.path.join(tempfile.mkdtemp(prefix="bchess-server-"), "engined.sock")
+    server = engined.Server(path, engined.Session)
+    server.pool = engined.EnginePool(specs, max_engines)
+    threading.Thread(target=server.serve_forever, name="engine-pool", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve bchess to many terminals from one process.")
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="the TCP port to listen on")
+    parser.add_argument("--max-engines", type=int, default=engined.MAX_ENGINES, help="engines to run per engine type, at most")
+    parser.add_argument("--pgn-dir", help="save the game of each session here (default: a new temporary directory)")
+    args = parser.parse_args()
+    pgn_dir = args.pgn_dir or tempfile.mkdtemp(prefix="bchess-server-games-")
+    config = bchess.default_config()
+    colors = AnsiColors()
+    config["style"] = bchess.config_implement_colors(config["style"], colors.init_pair, colors.color_pair)
+    book.default = book.BookDB(bchess.config_subs("{data}/openings.sqlite"))
+    pool = None
+    daemon_path = config.get("engined_socket", "")
+    daemon = engine.DaemonClient.connect(daemon_path) if daemon_path else None
+    if daemon is not None:
+        daemon.close()
+    else:
+        pool = start_engine_pool(config, args.max_engines)
+        daemon_path = pool.server_address
+    listener = socket.create_server((args.host, args.port), reuse_port=False)
+    listener.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ, None)
+    sessions = []
+    nsessions = 0
+    print(f"Listening on {args.host}:{args.port}, saving the games in {pgn_dir}")
+    def drop(session):
+        sel.unregister(session.sock)
+        sessions.remove(session)
+        session.close()
+    try:
+        while True:
+            fps = config.get("max_fps", 30) or 30
+            for key, events in sel.select(timeout=1/fps):
+                if key.data is None:
+                    sock, addr = listener.accept()
+                    nsessions += 1
+                    name = f"guest{nsessions}"
+                    session = TerminalSession(sock, config, colors, name, os.path.join(pgn_dir, f"{name}.pgn"),
+                        engine.DaemonClient.connect(daemon_path))
+                    sessions.append(session)
+                    sel.register(sock, selectors.EVENT_READ, session)
+                    continue
+                if not events & selectors.EVENT_READ:
+                    # Writable: step() sends the queued output.
+                    continue
+                try:
+                    alive = key.data.receive()
+                except OSError:
+                    alive = False
+                if not alive:
+                    drop(key.data)
+            for session in list(sessions):
+                try:
+                    session.step()
+                except (SystemExit, OSError):
+                    drop(session)
+                    continue
+                except Exception:
+                    # A bug in one session should not end the others.
+                    traceback.print_exc()
+                    drop(session)
+                    continue
+                # Wait for the terminal to take the queued output.
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.outbuf else 0)
+                if sel.get_key(session.sock).events != events:
+                    sel.modify(session.sock, events, session)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for session in list(sessions):
+            drop(session)
+        if pool is not None:
+            pool.pool.quit()
+
+if __name__ == "__main__":
+    main()
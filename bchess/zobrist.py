@@ -0,0 +1,221 @@
+"""
+Zobrist keys of chess positions (the Polyglot ones, as computed by
+chess.polyglot.zobrist_hash), updated incrementally as moves are
+made, and a Tracker that counts how many times each position of a
+game occurred, to answer the draw rules without replaying the game.
+"""
+
+import collections
+import chess
+import chess.polyglot
+
+RANDOM = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+hasher = chess.polyglot.ZobristHasher(RANDOM)
+# Piece symbol -> offset of its squares in RANDOM.
+PIECE_OFFSETS = {
+    chess.piece_symbol(piece_type).upper() if color else chess.piece_symbol(piece_type):
+        64*((piece_type - 1)*2 + color)
+    for piece_type in chess.PIECE_TYPES for color in chess.COLORS
+}
+
+def key(board):
+    """The Zobrist key of a board, computed from scratch."""
+    return hasher(board)
+
+def epd_key(epd):
+    """
+    The Zobrist key of a position given by its EPD (or FEN), without
+    making a chess.Board of it.
+    """
+    placement, turn, castling, ep = epd.split()[:4]
+    k = 0
+    pawns = set()
+    square = 56
+    for c in placement:
+        if c == "/":
+            square -= 16
+        elif c.isdigit():
+            square += int(c)
+        else:
+            k ^= RANDOM[PIECE_OFFSETS[c] + square]
+            if c in "Pp":
+                pawns.add((square, c == "P"))
+            square += 1
+    for i, c in enumerate("KQkq"):
+        if c in castling:
+            k ^= RANDOM[768 + i]
+    if ep != "-":
+        # Only if a pawn is ready to capture, as hash_ep_square().
+        white = turn == "w"
+        file = chess.FILE_NAMES.index(ep[0])
+        rank = 4 if white else 3
+        if any((chess.square(f, rank), white) in pawns for f in (file - 1, file + 1) if 0 <= f < 8):
+            k ^= RANDOM[772 + file]
+    if turn == "w":
+        k ^= RANDOM[780]
+    return k
+
+def piece_key(piece, square):
+    return RANDOM[64*((piece.piece_type - 1)*2 + piece.color) + square]
+
+def state_key(board):
+    """The part of the key of a board that is not the pieces."""
+    return hasher.hash_castling(board) ^ hasher.hash_ep_square(board) ^ hasher.hash_turn(board)
+
+def pieces_delta(board, move):
+    """
+    The change of the pieces part of the key of a board made by a
+    (pseudo-)legal move, which is not yet pushed.
+    """
+    if not move:
+        return 0
+    turn = board.turn
+    piece = board.piece_at(move.from_square)
+    delta = piece_key(piece, move.from_square)
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        kingside = board.is_kingside_castling(move)
+        target = board.piece_at(move.to_square)
+        if target is not None and target.piece_type == chess.ROOK and target.color == turn:
+            rook_from = move.to_square
+        else:
+            rook_from = chess.square(7 if kingside else 0, rank)
+        rook = chess.Piece(chess.ROOK, turn)
+        return delta ^ \
+            piece_key(piece, chess.square(6 if kingside else 2, rank)) ^ \
+            piece_key(rook, rook_from) ^ \
+            piece_key(rook, chess.square(5 if kingside else 3, rank))
+    captured = board.piece_at(move.to_square)
+    if captured is not None:
+        delta ^= piece_key(captured, move.to_square)
+    elif board.is_en_passant(move):
+        delta ^= piece_key(chess.Piece(chess.PAWN, not turn), move.to_square + (-8 if turn else 8))
+    if move.promotion:
+        piece = chess.Piece(move.promotion, turn)
+    return delta ^ piece_key(piece, move.to_square)
+
+class Tracker:
+    """
+    Follows a board, keeping the Zobrist key of each of its
+    positions, and how many times each key occurred; moves must be
+    pushed and popped through the tracker. The answers about the
+    current position are remembered until the next push or pop.
+
+    Positions are told apart by their Polyglot keys, so an en
+    passant capture that is possible but not legal makes positions
+    different (unlike for chess.Board, which replays the game).
+    """
+
+    def __init__(self, board):
+        self.board = board
+        # Per position of the game: (key, state_key).
+        self.keys = []
+        self.counts = collections.Counter()
+        self.memo = {}
+        replay = board.root()
+        self._record(key(replay), state_key(replay))
+        for move in board.move_stack:
+            delta = pieces_delta(replay, move)
+            replay.push(move)
+            self._advance(delta, replay)
+
+    @property
+    def key(self):
+        return self.keys[-1][0]
+
+    def _record(self, k, s):
+        self.keys.append((k, s))
+        self.counts[k] += 1
+        self.memo.clear()
+
+    def _advance(self, delta, board):
+        k, s = self.keys[-1]
+        s2 = state_key(board)
+        self._record(k ^ s ^ delta ^ s2, s2)
+
+    def push(self, move):
+        delta = pieces_delta(self.board, move)
+        self.board.push(move)
+        self._advance(delta, self.board)
+
+    def push_uci(self, uci):
+        move = self.board.parse_uci(uci)
+        self.push(move)
+        return move
+
+    def pop(self):
+        k, s = self.keys.pop()
+        self.counts[k] -= 1
+        if not self.counts[k]:
+            del self.counts[k]
+        self.memo.clear()
+        return self.board.pop()
+
+    def occurrences(self):
+        """How many times the current position occurred."""
+        return self.counts[self.key]
+
+    def key_after(self, move):
+        """
+        The key after a reversible move (see chess.Board.is_irreversible),
+        without making it: only the pieces and the turn change.
+        """
+        return self.key ^ hasher.hash_ep_square(self.board) ^ RANDOM[780] ^ pieces_delta(self.board, move)
+
+    def is_repetition(self, count=3):
+        return self.occurrences() >= count
+
+    def can_claim_threefold_repetition(self):
+        if "threefold" not in self.memo:
+            self.memo["threefold"] = self._can_claim_threefold_repetition()
+        return self.memo["threefold"]
+
+    def _can_claim_threefold_repetition(self):
+        if self.occurrences() >= 3:
+            return True
+        # Only a reversible move can repeat a position.
+        for move in self.board.generate_legal_moves():
+            if self.board.is_irreversible(move):
+                continue
+            if self.counts[self.key_after(move)] >= 2:
+                return True
+        return False
+
+    def can_claim_fifty_moves(self):
+        # Cheap: it only tries moves if the halfmove clock is 99.
+        return self.board.can_claim_fifty_moves()
+
+    def can_claim_draw(self):
+        return self.can_claim_fifty_moves() or self.can_claim_threefold_repetition()
+
+    def outcome(self, claim_draw=False):
+        """Like chess.Board.outcome()."""
+        if ("outcome", claim_draw) not in self.memo:
+            self.memo["outcome", claim_draw] = self._outcome(claim_draw)
+        return self.memo["outcome", claim_draw]
+
+    def _outcome(self, claim_draw):
+        board = self.board
+        if board.is_checkmate():
+            return chess.Outcome(chess.Termination.CHECKMATE, not board.turn)
+        if board.is_insufficient_material():
+            return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+        if not any(board.generate_legal_moves()):
+            return chess.Outcome(chess.Termination.STALEMATE, None)
+        if board.is_seventyfive_moves():
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        if self.is_repetition(5):
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        if claim_draw:
+            if self.can_claim_fifty_moves():
+                return chess.Outcome(chess.Termination.FIFTY_MOVES, None)
+            if self.can_claim_threefold_repetition():
+                return chess.Outcome(chess.Termination.THREEFOLD_REPETITION, None)
+        return None
+
+    def is_game_over(self, claim_draw=False):
+        return self.outcome(claim_draw=claim_draw) is not None
+
+    def result(self, claim_draw=False):
+        outcome = self.outcome(claim_draw=claim_draw)
+        return outcome.result() if outcome else "*"
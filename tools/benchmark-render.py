@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# This script measures how long it takes to render UI frames,
+# using an in-memory screen instead of a terminal. Run it from
+# the top directory:
+#
+#     python3 tools/benchmark-render.py [--frames N]
+#
+# For each scenario it reports the frames per second, the peak
+# memory in use while rendering a frame (above what was in use
+# before it), and the number of memory blocks that stay allocated
+# per frame (from a tracemalloc snapshot diff, so temporary
+# allocations don't count; it should stay near zero, or memory
+# is leaking). With --profile it also shows the time spent in
+# each named region.
+
+import argparse
+import os.path
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import chess
+
+from bchess import bchess
+from bchess import engine
+from bchess import imui
+
+def random_game(nplies, seed=1):
+    """
+    Return a list of random moves lasting nplies, or less if the
+    game can't be continued.
+    """
+    rnd = random.Random(seed)
+    board = chess.Board()
+    moves = []
+    while len(moves) < nplies:
+        candidates = list(board.legal_moves)
+        rnd.shuffle(candidates)
+        for move in candidates:
+            board.push(move)
+            over = board.is_game_over()
+            board.pop()
+            if not over: break
+        else:
+            break
+        board.push(move)
+        moves.append(move)
+    return moves
+
+def make_ui(config, nplies, help=False):
+    ui = bchess.UI(None, None, config)
+    for move in random_game(nplies):
+        ui.san_moves.append(ui.board.san(move))
+        ui.tracker.push(move)
+    if help:
+        board = ui.board.copy()
+        pv = []
+        for i in range(3):
+            move = next(iter(board.legal_moves), None)
+            if move is None: break
+            pv.append(move.uci())
+            board.push(move)
+        key = ui.tracker.key
+        ui.eval[key] = {
+            depth: engine.Evaluation(engine.Score_CentiPawn(20 + depth), None, depth, 0, 1, pv)
+            for depth in range(4, 21)
+        }
+        ui.eval_maxdepth[key] = 20
+        ui.help = True
+    return ui
+
+def scenarios(config):
+    menu = bchess.UI0(config)
+    # Don't start the engines of the highlighted opponents.
+    menu.speculate = lambda aispec: None
+    yield "menu", menu.render
+    yield "short game", make_ui(config, 12).render
+    yield "300-ply game", make_ui(config, 300).render
+    yield "short game, help", make_ui(config, 12, help=True).render
+    yield "300-ply game, help", make_ui(config, 300, help=True).render
+
+def benchmark(im, screen, render, nframes):
+    t1 = time.perf_counter()
+    for i in range(nframes):
+        with im.Frame(screen):
+            render()
+    t2 = time.perf_counter()
+    # The profile is of the timed frames only.
+    profiler, im.profiler = im.profiler, None
+    tracemalloc.start()
+    peak = 0
+    ntraced = min(nframes, 100)
+    before = tracemalloc.take_snapshot()
+    for i in range(ntraced):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        with im.Frame(screen):
+            render()
+        _, top = tracemalloc.get_traced_memory()
+        peak = max(peak, top - base)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    im.profiler = profiler
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    kept = sum(stat.count_diff for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters), "filename"))
+    return nframes/(t2 - t1), peak, kept/max(ntraced, 1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark UI rendering.")
+    parser.add_argument("-n", "--frames", type=int, default=500, help="frames to render per scenario")
+    parser.add_argument("--width", type=int, default=100, help="screen width")
+    parser.add_argument("--height", type=int, default=40, help="screen height")
+    parser.add_argument("--profile", action="store_true", help="show per-region frame times")
+    args = parser.parse_args()
+    config = bchess.default_config()
+    config["style"] = {key: 0 for key in config["style"]}
+    config["eval_ai"] = None
+    bchess.im = im = imui.IM()
+    screen = imui.VirtualScreen(args.height, args.width)
+    print(f"{'scenario':<20} {'frames/s':>9} {'ms/frame':>9} {'peak KiB':>9} {'kept blocks':>12}")
+    for name, render in scenarios(config):
+        if args.profile:
+            im.profiler = imui.Profiler()
+        fps, peak, kept = benchmark(im, screen, render, args.frames)
+        print(f"{name:<20} {fps:9.1f} {1000/fps:9.2f} {peak/1024:9.1f} {kept:12.1f}")
+        if args.profile:
+            for line in im.profiler.format():
+                print("    " + line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+# This script builds the opening book (openings.sql, the boards
+# and moves tables read by bchess/book.py) from PGN dumps, such
+# as the monthly ones from https://database.lichess.org/. Run it
+# from the top directory:
+#
+#     python3 tools/build-book.py [-j N] [-o openings.sql] games.pgn.zst ...
+#
+# The files may be plain, or compressed with gzip, bzip2, xz, or
+# zstd (if the zstandard module is installed). Plain files are
+# split into chunks by byte offset, compressed ones are streamed
+# and cut into chunks of text; either way the chunks are counted
+# in parallel by worker processes. The workers write their counts
+# to NSHARDS shard files by board (in a temporary directory, see
+# TMPDIR), which are then added up and pruned in parallel, one
+# shard at a time, so that the counts of all the boards of a dump
+# are never in memory at once.
+#
+# With --merge, the counts (e.g. of a new month of games) are
+# instead added to an existing openings.sqlite in place, and with
+# --evaluations, the evaluations written by evaluate-openings.py
+# replace the ones in it; only the affected rows are touched. The
+# counts too low to make it into the book are kept in its
+# pending_moves table, to be added to by the next merges:
+#
+#     python3 tools/build-book.py --merge bchess/data/openings.sqlite \
+#         [--evaluations new.evaluations.sqlite] [games.pgn.zst ...]
+#
+# bchess opens the book with immutable=1, trusting that it does
+# not change underneath, so it must not be running meanwhile.
+
+import argparse
+import bz2
+import collections
+import gzip
+import lzma
+import multiprocessing
+import os
+import re
+import pickle
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bchess import book as bookdb
+
+# Only the first MAXPLY plies of each game are counted.
+MAXPLY = 24
+# Moves are counted for the player's rating bucket: a move by a
+# player rated 1250 counts for the 1300 one. Players outside of
+# the buckets are not counted.
+ELO_BUCKETS = [1100, 1300, 1500, 1700, 1900]
+ELO_WIDTH = 200
+# Boards with fewer moves than this (summed over the buckets),
+# and moves played less often than this in a bucket, are left
+# out of the book.
+MIN_BOARD_MOVES = 10
+MIN_MOVE_COUNT = 2
+# The size of a chunk of PGN text given to a worker.
+CHUNK_SIZE = 64*2**20
+JOBS = os.cpu_count() or 1
+# The counts are added up in this many parts, by board.
+NSHARDS = 256
+
+RX_COMMENT = re.compile(r"\{[^}]*\}|\([^()]*\)|;[^\n]*")
+RX_SKIP = re.compile(r"\d+\.+|\$\d+|1-0|0-1|1/2-1/2|\*")
+RX_ANNOTATION = re.compile(r"[?!]+$")
+
+def open_pgn(filename):
+    if filename.endswith(".gz"): return gzip.open(filename, "rt", encoding="utf-8", errors="replace")
+    if filename.endswith(".bz2"): return bz2.open(filename, "rt", encoding="utf-8", errors="replace")
+    if filename.endswith(".xz"): return lzma.open(filename, "rt", encoding="utf-8", errors="replace")
+    if filename.endswith(".zst"):
+        import io
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"))
+        return io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+    return open(filename, "r", encoding="utf-8", errors="replace")
+
+def elo_bucket(elo):
+    for bucket in ELO_BUCKETS:
+        if bucket - ELO_WIDTH//2 <= elo < bucket + ELO_WIDTH//2:
+            return bucket
+    return None
+
+def count_game(headers, movetext, counts):
+    """
+    Add the moves of one game to counts, a dict mapping
+    (epd, elo bucket, uci) to the number of times played.
+    """
+    if headers.get("Variant", "Standard") != "Standard" or "FEN" in headers:
+        return
+    try:
+        buckets = (elo_bucket(int(headers.get("WhiteElo", ""))), elo_bucket(int(headers.get("BlackElo", ""))))
+    except ValueError:
+        return
+    if buckets == (None, None):
+        return
+    board = chess.Board()
+    for token in RX_COMMENT.sub(" ", movetext).split():
+        if RX_SKIP.fullmatch(token): continue
+        if len(board.move_stack) >= MAXPLY: break
+        try:
+            move = board.parse_san(RX_ANNOTATION.sub("", token))
+        except ValueError:
+            return
+        bucket = buckets[0 if board.turn == chess.WHITE else 1]
+        if bucket is not None:
+            key = (board.epd(), bucket, move.uci())
+            counts[key] = counts.get(key, 0) + 1
+        board.push(move)
+
+def count_lines(lines):
+    """
+    Count the moves of the games in an iterable of PGN lines.
+    A game is counted once the line after its movetext is seen,
+    so a partial game at the start (without headers) is ignored.
+    """
+    counts = {}
+    headers = {}
+    movetext = []
+    for line in lines:
+        if line.startswith("["):
+            if movetext:
+                if headers: count_game(headers, " ".join(movetext), counts)
+                headers = {}
+                movetext = []
+            key, _, value = line[1:].partition(" ")
+            headers[key] = value.strip().rstrip("]").strip('"')
+        elif line.strip():
+            movetext.append(line)
+    if headers and movetext:
+        count_game(headers, " ".join(movetext), counts)
+    return counts
+
+def count_range(task):
+    """
+    Count the games starting in a byte range of a plain PGN
+    file. The last one is followed past the end of the range.
+    """
+    filename, start, end = task
+    def lines():
+        with open(filename, "rb") as f:
+            if start > 0:
+                # Skip to the first full line in the range.
+                f.seek(start - 1)
+                f.readline()
+            pos = f.tell()
+            started = False
+            for line in f:
+                if line.startswith(b"[Event "):
+                    if pos >= end: break
+                    started = True
+                pos += len(line)
+                if started:
+                    yield line.decode("utf-8", errors="replace")
+    return count_lines(lines())
+
+def count_text(text):
+    return count_lines(text.splitlines())
+
+def text_chunks(filename):
+    """
+    Yield the text of a compressed PGN file in chunks of about
+    CHUNK_SIZE, cut between games.
+    """
+    with open_pgn(filename) as f:
+        lines = []
+        size = 0
+        for line in f:
+            if size >= CHUNK_SIZE and line.startswith("[Event "):
+                yield "".join(lines)
+                lines = []
+                size = 0
+            lines.append(line)
+            size += len(line)
+        if lines:
+            yield "".join(lines)
+
+def plain_ranges(filename, njobs):
+    size = os.path.getsize(filename)
+    nchunks = max(njobs*4, size//CHUNK_SIZE + 1)
+    step = size//nchunks + 1
+    return [(filename, start, min(start + step, size)) for start in range(0, size, step)]
+
+def shard_of(epd):
+    return zlib.crc32(epd.encode("ascii")) % NSHARDS
+
+def count_chunk(task):
+    """
+    Count a chunk with count_range or count_text, and append the
+    counts to the files of their shards (one per shard and worker
+    process). Return the number of counts.
+    """
+    count, chunk, shard_dir = task
+    counts = count(chunk)
+    shards = collections.defaultdict(dict)
+    for key, n in counts.items():
+        shards[shard_of(key[0])][key] = n
+    for shard, shard_counts in shards.items():
+        with open(os.path.join(shard_dir, f"{shard}.{os.getpid()}"), "ab") as f:
+            pickle.dump(shard_counts, f, pickle.HIGHEST_PROTOCOL)
+    return len(counts)
+
+def count_files(filenames, njobs, shard_dir):
+    """
+    Count the moves in all the PGN files, in parallel, into the
+    shard files in shard_dir (see read_shard).
+    """
+    t0 = time.time()
+    nchunks = 0
+    with multiprocessing.Pool(njobs) as pool:
+        for filename in filenames:
+            if filename.endswith(".pgn"):
+                tasks = ((count_range, r, shard_dir) for r in plain_ranges(filename, njobs))
+            else:
+                tasks = ((count_text, text, shard_dir) for text in text_chunks(filename))
+            for n in pool.imap_unordered(count_chunk, tasks):
+                nchunks += 1
+                print(f"{filename}: {nchunks} chunks, {n} counts, {time.time() - t0:.0f}s")
+
+def read_shard(task):
+    """
+    Add up the counts of a shard, prune them unless min_counts is
+    None, and delete its files. Return a dict mapping epd to a
+    dict mapping elo bucket to a Counter of uci moves.
+    """
+    shard_dir, shard, min_counts = task
+    book = {}
+    for name in os.listdir(shard_dir):
+        if name.split(".")[0] != str(shard): continue
+        path = os.path.join(shard_dir, name)
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    counts = pickle.load(f)
+                except EOFError:
+                    break
+                for (epd, elo, uci), n in counts.items():
+                    book.setdefault(epd, {}).setdefault(elo, collections.Counter())[uci] += n
+        os.unlink(path)
+    if min_counts is not None:
+        prune(book, *min_counts)
+    return book
+
+def read_shards(shard_dir, njobs, min_counts=None):
+    """
+    Yield the (epd, counts by elo bucket) of all the boards, read
+    from the shards in parallel; see read_shard.
+    """
+    tasks = [(shard_dir, shard, min_counts) for shard in range(NSHARDS)]
+    with multiprocessing.Pool(njobs) as pool:
+        for i, book in enumerate(pool.imap_unordered(read_shard, tasks), 1):
+            print(f"shard {i}/{NSHARDS}: {len(book)} boards")
+            yield from book.items()
+
+def prune(book, min_board_moves=MIN_BOARD_MOVES, min_move_count=MIN_MOVE_COUNT):
+    """
+    Drop the rare moves and boards from the counts, in place.
+    """
+    for epd in list(book.keys()):
+        byelo = book[epd]
+        for elo in list(byelo.keys()):
+            moves = byelo[elo]
+            for uci in [uci for uci, n in moves.items() if n < min_move_count]:
+                del moves[uci]
+            if not moves:
+                del byelo[elo]
+        if sum(n for moves in byelo.values() for n in moves.values()) < min_board_moves:
+            del book[epd]
+
+def format_moves(moves):
+    return " ".join(f"{uci}:{n}" for uci, n in sorted(moves.items(), key=lambda kv: (-kv[1], kv[0])))
+
+def write_sql(book, filename):
+    """
+    Write the boards and moves tables as an SQL dump, with the
+    most popular boards first.
+    """
+    popularity = {epd: sum(n for moves in byelo.values() for n in moves.values()) for epd, byelo in book.items()}
+    with open(filename, "w") as f:
+        f.write("BEGIN TRANSACTION;\n")
+        f.write("CREATE TABLE boards(id integer primary key, epd text);\n")
+        f.write("CREATE TABLE moves(boardid integer, elo integer, moves text);\n")
+        for boardid, epd in enumerate(sorted(book.keys(), key=lambda epd: (-popularity[epd], epd)), 1):
+            f.write(f"INSERT INTO boards VALUES({boardid},'{epd}');\n")
+            for elo, moves in sorted(book[epd].items()):
+                f.write(f"INSERT INTO moves VALUES({boardid},{elo},'{format_moves(moves)}');\n")
+        f.write("CREATE INDEX boards_epd on boards(epd);\n")
+        f.write("CREATE INDEX moves_boardid on moves(boardid);\n")
+        f.write("COMMIT;\n")
+
+def parse_moves(movestring):
+    moves = collections.Counter()
+    for mc in movestring.split():
+        uci, count = mc.split(":")
+        moves[uci] = int(count)
+    return moves
+
+def merge_book(book, filename, min_board_moves=MIN_BOARD_MOVES, min_move_count=MIN_MOVE_COUNT):
+    """
+    Add the counts (an iterable of (epd, counts by elo bucket), as
+    from read_shards) to the boards and moves tables of an existing
+    database, in one transaction. Boards new to the book are added
+    only if they have at least min_board_moves moves, and moves new
+    to a row of the book only once their total count reaches
+    min_move_count; until then their counts are kept in the
+    pending_moves table, so that the counts of several merges add
+    up. A count is either in the book or pending, never both.
+    """
+    db = sqlite3.connect(filename)
+    db.execute("create table if not exists pending_moves(epd text, elo integer, moves text, primary key(epd, elo))")
+    has_nmoves = db.execute("select count(*) from sqlite_master where name='nmoves'").fetchone()[0] > 0
+    has_keys = db.execute("select count(*) from sqlite_master where name='board_keys'").fetchone()[0] > 0
+    nextid = (db.execute("select max(id) from boards").fetchone()[0] or 0) + 1
+    nupdated = nadded = npending = 0
+    with db:
+        for epd, byelo in book:
+            row = db.execute("select id from boards where epd=?", (epd,)).fetchone()
+            boardid = row[0] if row else None
+            pending = {elo: parse_moves(moves) for elo, moves in
+                db.execute("select elo, moves from pending_moves where epd=?", (epd,))}
+            # elo -> (the moves in the book, all the moves)
+            merged = {}
+            for elo in set(byelo) | (set(pending) if boardid is None else set()):
+                row = db.execute("select moves from moves where boardid=? and elo=?", (boardid, elo)).fetchone() \
+                    if boardid is not None else None
+                moves = parse_moves(row[0]) if row else collections.Counter()
+                merged[elo] = (moves, moves + pending.get(elo, collections.Counter()) + byelo.get(elo, collections.Counter()))
+            if boardid is None:
+                total = sum(n for _, moves in merged.values() for n in moves.values() if n >= min_move_count)
+                if total < min_board_moves:
+                    for elo, (_, moves) in merged.items():
+                        db.execute("insert or replace into pending_moves values (?,?,?)", (epd, elo, format_moves(moves)))
+                    npending += 1
+                    continue
+                boardid = nextid
+                nextid += 1
+                db.execute("insert into boards values (?,?)", (boardid, epd))
+                if has_keys:
+                    db.execute("insert or ignore into board_keys values (?,?)", (bookdb.epd_key(epd), boardid))
+                nadded += 1
+            else:
+                nupdated += 1
+            delta = 0
+            for elo, (inbook, moves) in merged.items():
+                # The moves already in the book stay there, whatever
+                # their count.
+                kept = collections.Counter({uci: n for uci, n in moves.items() if uci in inbook or n >= min_move_count})
+                rest = collections.Counter({uci: n for uci, n in moves.items() if uci not in kept})
+                delta += sum(kept.values()) - sum(inbook.values())
+                if rest:
+                    db.execute("insert or replace into pending_moves values (?,?,?)", (epd, elo, format_moves(rest)))
+                elif elo in pending:
+                    db.execute("delete from pending_moves where epd=? and elo=?", (epd, elo))
+                if kept == inbook: continue
+                if inbook:
+                    db.execute("update moves set moves=? where boardid=? and elo=?", (format_moves(kept), boardid, elo))
+                else:
+                    db.execute("insert into moves values (?,?,?)", (boardid, elo, format_moves(kept)))
+            if has_nmoves and delta:
+                db.execute("insert into nmoves values (?,?) on conflict(boardid) do update set nmoves=nmoves+excluded.nmoves", (boardid, delta))
+    db.close()
+    print(f"Updated boards: {nupdated}, added boards: {nadded}, pending boards: {npending}")
+
+def merge_evaluations(filename, evalfilename):
+    """
+    Replace the evaluations of the boards evaluated in evalfilename
+    (an output of evaluate-openings.py) in an existing database.
+    """
+    db = sqlite3.connect(filename)
+    db.execute("attach database ? as src", (evalfilename,))
+    packed = db.execute("select count(*) from main.sqlite_master where name='evaluations'").fetchone()[0] == 0
+    if packed:
+        db.execute("create table if not exists packed_evaluations(boardid integer primary key, depth integer, scores blob, pv blob)")
+    nboards = 0
+    with db:
+        evals = []
+        for row in db.execute("select boardid, depth, score, pv from src.evaluations order by boardid, depth").fetchall():
+            if evals and row[0] != evals[-1][0]:
+                nboards += 1
+                merge_board_evaluations(db, packed, evals)
+                evals = []
+            evals.append(row)
+        if evals:
+            nboards += 1
+            merge_board_evaluations(db, packed, evals)
+    db.execute("detach database src")
+    db.close()
+    print(f"Merged evaluations of {nboards} boards")
+
+def merge_board_evaluations(db, packed, evals):
+    boardid = evals[0][0]
+    if packed:
+        db.execute("insert or replace into packed_evaluations values (?,?,?,?)",
+            bookdb.pack_evaluations(boardid, [row[1:] for row in evals]))
+    else:
+        db.execute("delete from main.evaluations where boardid=?", (boardid,))
+        db.executemany("insert into main.evaluations values (?,?,?,?)", evals)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the opening book from PGN files.")
+    parser.add_argument("pgn", nargs="*", help="PGN files, possibly compressed")
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS, help="number of worker processes")
+    parser.add_argument("-o", "--output", default="openings.sql", help="the SQL dump to write")
+    parser.add_argument("--min-board-moves", type=int, default=MIN_BOARD_MOVES, help="leave out boards with fewer moves")
+    parser.add_argument("--min-move-count", type=int, default=MIN_MOVE_COUNT, help="leave out moves played fewer times")
+    parser.add_argument("--merge", metavar="SQLITE", help="add the counts to this database instead of writing a dump")
+    parser.add_argument("--evaluations", metavar="SQLITE", help="with --merge, also merge these evaluations")
+    args = parser.parse_args()
+    if args.evaluations and not args.merge:
+        parser.error("--evaluations requires --merge")
+    if not args.pgn and not args.evaluations:
+        parser.error("no PGN files given")
+    with tempfile.TemporaryDirectory(prefix="build-book-") as shard_dir:
+        count_files(args.pgn, args.jobs, shard_dir)
+        if args.merge:
+            if args.pgn:
+                merge_book(read_shards(shard_dir, args.jobs), args.merge, args.min_board_moves, args.min_move_count)
+            if args.evaluations:
+                merge_evaluations(args.merge, args.evaluations)
+            return
+        book = dict(read_shards(shard_dir, args.jobs, (args.min_board_moves, args.min_move_count)))
+    print(f"Kept boards: {len(book)}")
+    write_sql(book, args.output)
+    print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
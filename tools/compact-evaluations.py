@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# This script replaces the evaluations table of an opening book
+# database (a row for every board and depth, with text scores and
+# PVs) by the packed_evaluations table (a row per board, with only
+# the last few depths and the deepest PV, packed as integers), as
+# described in bchess/book.py, and adds the board_keys table (for
+# looking boards up by their Zobrist keys) if it is missing. Run it
+# from the top directory:
+#
+#     python3 tools/compact-evaluations.py bchess/data/openings.sqlite
+#
+# SConstruct does the same when building openings.sqlite, so this
+# is for databases built before.
+
+import argparse
+import os.path
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bchess import book
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the evaluations of an opening book database.")
+    parser.add_argument("database", help="the database to compact in place")
+    args = parser.parse_args()
+    size = os.path.getsize(args.database)
+    with sqlite3.connect(args.database) as db:
+        nrows, nboards = db.execute("select count(*), count(distinct boardid) from evaluations").fetchone()
+        print(f"Evaluations: {nrows} rows for {nboards} boards")
+        db.execute("drop table if exists packed_evaluations")
+        book.compact_evaluations(db)
+        db.execute("drop table evaluations")
+        if not db.execute("select count(*) from sqlite_master where name='board_keys'").fetchone()[0]:
+            book.index_board_keys(db)
+        db.commit()
+        db.execute("vacuum")
+    print(f"Size: {size/2**20:.1f} MiB -> {os.path.getsize(args.database)/2**20:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
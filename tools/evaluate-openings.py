@@ -1,49 +1,125 @@
 #!/usr/bin/env python3
+import argparse
 import sqlite3
 import collections
+import contextlib
+import multiprocessing
+import os
+import queue
+import socket
 import subprocess
 import time
 import chess
 
 MAXDEPTH = 36
-THREADS = 16
+# The search stops early once the best move stayed the same, and
+# the score within CONVERGE_CP, for CONVERGE_DEPTHS consecutive
+# depths, the last of which is at least MINDEPTH.
+MINDEPTH = 20
+CONVERGE_DEPTHS = 4
+CONVERGE_CP = 15
+# Or when the time budget runs out, at any depth. The budget of
+# a position is BUDGET seconds scaled by the square root of its
+# popularity relative to the average one (clipped to 1/4..4
+# times). Budget left unspent by positions that converge quickly
+# is banked, and positions that do not converge can take up to
+# BUDGET_EXTRA times their own budget from the bank.
+BUDGET = 120
+BUDGET_EXTRA = 2
+# Positions along the PV of an analyzed position get "harvested"
+# evaluations of its depth minus 1, minus 2, etc; if one of them
+# is at most HARVEST_SLACK plies shallower than the median depth
+# of the last HARVEST_SAMPLES searches (MAXDEPTH before there are
+# any), the position is not searched.
+HARVEST_SLACK = 2
+HARVEST_SAMPLES = 100
+# The number of engine processes, and the number of threads for
+# each one. SMP search scales sub-linearly, so many engines with
+# a few threads each finish the book faster than one big engine.
+JOBS = 4
+THREADS = 4
+# Hash table size in MB, shared between all the engines.
+HASH = 4096
+# Evaluations are committed to the output database in batches
+# of this many boards, or this many seconds, whichever is first.
+BATCH = 16
+BATCH_TIME = 30
+OUTPUT = "new.evaluations.sqlite"
+# With --queue, boards are leased for this many seconds, and the
+# leases are renewed while the boards are being analyzed.
+LEASE_TIME = 600
 ENGINE = ["./bchess/data/stockfish"]
 OPTIONS = {
     "UCI_AnalyseMode": "true",
-    "Threads": str(THREADS),
-    "Hash": "4096",
     "EvalFile": "bchess/data/default.nnue"
 }
 
-ENG = subprocess.Popen(ENGINE,
-                encoding="utf-8",
-                universal_newlines=True,
-                bufsize=1,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL)
-ENG.stdin.write("uci\n")
-for line in ENG.stdout:
-    #print(">", line)
-    if line.strip() == "uciok": break
-ENG.stdin.write("".join([
-    f"setoption name {name} value {value}\n"
-    for name, value in OPTIONS.items()
-]))
-
-def analyze_position(fen, flip):
+def start_engine(threads, hash):
+    eng = subprocess.Popen(ENGINE,
+                    encoding="utf-8",
+                    universal_newlines=True,
+                    bufsize=1,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL)
+    eng.stdin.write("uci\n")
+    for line in eng.stdout:
+        #print(">", line)
+        if line.strip() == "uciok": break
+    options = dict(OPTIONS, Threads=str(threads), Hash=str(hash))
+    eng.stdin.write("".join([
+        f"setoption name {name} value {value}\n"
+        for name, value in options.items()
+    ]))
+    return eng
+
+def converged(evals):
+    """
+    Check if the last CONVERGE_DEPTHS of the given list of
+    (score, pv) pairs agree on the best move and the score.
+    """
+    if len(evals) < CONVERGE_DEPTHS: return False
+    evals = evals[-CONVERGE_DEPTHS:]
+    moves = set(pv.split(" ")[0] for score, pv in evals)
+    if len(moves) != 1: return False
+    scores = [score for score, pv in evals]
+    if all(score.startswith("cp ") for score in scores):
+        values = [int(score[3:]) for score in scores]
+        return max(values) - min(values) <= CONVERGE_CP
+    return len(set(scores)) == 1
+
+def analyze_position(eng, fen, flip, budget=None):
+    """
+    Analyze the position up to MAXDEPTH, or until the search
+    converges, or runs out of its time budget (in seconds).
+    Return the evaluation of each completed depth, and the
+    reason the search stopped.
+
+    Info lines with a lowerbound or upperbound score are the
+    partial results of a depth in progress, and are skipped;
+    the others come when a depth is completed.
+    """
     depth2eval = {}
+    reason = "maxdepth"
+    t0 = time.time()
     if 1:
-        ENG.stdin.write("".join([
+        eng.stdin.write("".join([
             f"position fen {fen}\n",
             f"go depth {MAXDEPTH}\n"
         ]))
-        for line in ENG.stdout:
+        for line in eng.stdout:
             #print(">", line.strip())
             if line.startswith("bestmove"):
                 break
             words = line.split()
-            if words[0] == "info":
+            if reason == "maxdepth":
+                if depth2eval and max(depth2eval) >= MINDEPTH and converged(list(depth2eval.values())):
+                    reason = "converged"
+                elif budget is not None and time.time() - t0 > budget:
+                    reason = "budget"
+                if reason != "maxdepth":
+                    eng.stdin.write("stop\n")
+            if words and words[0] == "info" and "lowerbound" not in words and "upperbound" not in words:
                 try:
                     depth = int(words[words.index("depth") + 1])
                     pv = words[words.index("pv") + 1:]
@@ -61,71 +137,407 @@ def analyze_position(fen, flip):
                 except ValueError as e:
                     # No "score", "depth", or "nodes".
                     pass
-    return [(depth, score, pv) for depth, (score, pv) in depth2eval.items()]
-
-db = sqlite3.connect(f"file:bchess/data/openings.sqlite?immutable=1", uri=True, check_same_thread=False)
-
-print("* Sorting positions")
-boardid2nmoves = collections.defaultdict(lambda: 0)
-for boardid, movestring in db.execute("select boardid, moves from moves"):
-    boardid2nmoves[boardid] += sum(int(mc.split(":")[1]) for mc in movestring.split())
-print(f"Total positions: {len(boardid2nmoves)}")
-print(f"Total moves: {sum(boardid2nmoves.values())}")
-
-boardid2epd = {}
-epd2boardid = {}
-for boardid, epd in db.execute("select id, epd from boards"):
-    boardid2epd[boardid] = epd
-    epd2boardid[epd] = boardid
-
-done = set()
-nsum = 0
-for boardid, in db.execute("select distinct boardid from evaluations"):
-    done.add(boardid)
-    nsum += boardid2nmoves[boardid]
-print(f"Already done: {len(done)} of {len(boardid2nmoves)} boards")
-
-db.close()
-
-todo = sorted(boardid2nmoves.keys(), key=lambda bid: -boardid2nmoves[bid])
-print(f"Highest move count: {boardid2nmoves[todo[0]]}")
-print(f"Lowest move count: {boardid2nmoves[todo[-1]]}")
-nmoves_total = sum(boardid2nmoves.values())
-with open("new.evaluations.sql", "w", buffering=1) as f:
-    f.write("""\
-PRAGMA foreign_keys=OFF;
-BEGIN TRANSACTION;
-CREATE TABLE evaluations(boardid integer, depth integer, score text, pv text, foreign key(boardid) references boards(id));
-""")
+    evaluation = [(depth, score, pv) for depth, (score, pv) in depth2eval.items()]
+    return evaluation, reason
+
+def shift_score(score, plies, white):
+    """
+    Return the (white's point of view) score of the position
+    that is plies moves along the PV of a position with the
+    given score and side to move. Return None if the PV ends
+    in a mate before that.
+    """
+    if not score.startswith("mate "):
+        return score
+    n = int(score[5:])
+    if n == 0:
+        return None
+    # The number of plies till mate from the original position.
+    winner_to_move = (n > 0) == white
+    total = 2*abs(n) - 1 if winner_to_move else 2*abs(n)
+    left = total - plies
+    if left <= 0:
+        return None
+    return f"mate {(left + 1)//2 if n > 0 else -((left + 1)//2)}"
+
+def harvest_pv(epd, depth, score, pv, boardid):
+    """
+    Yield (boardid, depth, score, pv) for each book position
+    reached along the PV, with the depth reduced by the number
+    of plies played. The book is keyed by EPD, so transpositions
+    into a book position are found too.
+    """
+    board = chess.Board(epd)
+    white = board.turn
+    moves = pv.split()
+    for i, move in enumerate(moves[:-1]):
+        board.push_uci(move)
+        plies = i + 1
+        bid = boardid(board.epd())
+        if bid is None: continue
+        hscore = shift_score(score, plies, white)
+        if hscore is None: break
+        yield bid, depth - plies, hscore, " ".join(moves[plies:])
+
+def worker(threads, hash, tasks, results):
+    """
+    Analyze positions from the tasks queue with a dedicated
+    engine until None is received; put the evaluations into
+    the results queue.
+    """
+    eng = start_engine(threads, hash)
     try:
         while True:
-            bid = todo.pop(0)
-            epd = boardid2epd[bid]
-            if bid in done: continue
-            done.add(bid)
-            nsum += boardid2nmoves[bid]
-            percentile = nsum/nmoves_total
-            print(f"* Board #{len(done)}, id {bid} ({nsum/nmoves_total*100:.0f}% of moves so far)")
+            task = tasks.get()
+            if task is None: break
+            bid, epd, budget = task
             board = chess.Board(epd)
-            print(board.unicode())
             t1 = time.time()
-            evaluation = analyze_position(epd, not board.turn)
+            evaluation, reason = analyze_position(eng, epd, not board.turn, budget)
             t2 = time.time()
-            #f.write(f"INSERT INTO boards VALUES({bid},'{epd}');\n")
-            for depth, score, pv in evaluation[-4:]:
-                print(f" d{depth}, {score}, {pv[:5*10]}")
-            print(f" t -> {t2-t1:.1f}s")
-            for depth, score, pv in evaluation:
-                f.write(f"INSERT INTO evaluations VALUES({bid},{depth},'{score}','{pv}');\n")
-            f.flush()
-            move = pv.split(" ")[0]
-            board.push_uci(move)
-            if board.epd() in epd2boardid:
-                print("Will continue with", move)
-                todo.insert(0, epd2boardid[board.epd()])
+            results.put((bid, evaluation, t2 - t1, reason))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        eng.kill()
+
+class Book:
+    """
+    Lookups in the opening book database. Boards are looked up
+    by id or EPD on demand, rather than loaded at startup.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(f"file:{filename}?immutable=1", uri=True, check_same_thread=False)
+
+    def epd(self, bid):
+        for epd, in self.db.execute("select epd from boards where id=?", (bid,)):
+            return epd
+        return None
+
+    def boardid(self, epd):
+        for bid, in self.db.execute("select id from boards where epd=?", (epd,)):
+            return bid
+        return None
+
+    def ranking(self):
+        """
+        Return a list of (boardid, number of moves played from
+        it), most popular boards first.
+        """
+        try:
+            return self.db.execute("select boardid, nmoves from nmoves order by nmoves desc, boardid").fetchall()
+        except sqlite3.OperationalError:
+            # An older database, without the precomputed totals.
+            print("No nmoves table, counting the moves")
+            boardid2nmoves = collections.defaultdict(lambda: 0)
+            for boardid, movestring in self.db.execute("select boardid, moves from moves"):
+                boardid2nmoves[boardid] += sum(int(mc.split(":")[1]) for mc in movestring.split())
+            return sorted(boardid2nmoves.items(), key=lambda kv: -kv[1])
+
+    def evaluated(self):
+        if self.db.execute("select count(*) from sqlite_master where name='packed_evaluations'").fetchone()[0]:
+            return [bid for bid, in self.db.execute("select boardid from packed_evaluations")]
+        return [bid for bid, in self.db.execute("select distinct boardid from evaluations")]
+
+def open_output(filename):
+    """
+    Open (or create) the output database. Next to the evaluations
+    it contains a checkpoint table recording which boards were
+    handed to the engines ("inflight"), and which are "done".
+    """
+    out = sqlite3.connect(filename, timeout=60)
+    out.executescript("""
+        CREATE TABLE IF NOT EXISTS evaluations(boardid integer, depth integer, score text, pv text);
+        CREATE TABLE IF NOT EXISTS checkpoint(boardid integer primary key, status text, time real);
+        CREATE TABLE IF NOT EXISTS harvested(boardid integer primary key, depth integer, score text, pv text);
+    """)
+    return out
+
+class Writer:
+    """
+    Batches evaluation results and checkpoint updates, and
+    commits them together, so after a crash the output database
+    is consistent: a board is "done" only if its evaluations
+    are there.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.evaluations = []
+        self.checkpoints = []
+        self.harvests = []
+        self.nboards = 0
+        self.last_commit = time.time()
+
+    def started(self, bid):
+        self.checkpoints.append((bid, "inflight", time.time()))
+
+    def finished(self, bid, evaluation):
+        self.evaluations.extend((bid, depth, score, pv) for depth, score, pv in evaluation)
+        self.checkpoints.append((bid, "done", time.time()))
+        self.nboards += 1
+        if self.nboards >= BATCH or time.time() - self.last_commit >= BATCH_TIME:
+            self.commit()
+
+    def harvested(self, bid, depth, score, pv):
+        self.harvests.append((bid, depth, score, pv))
+
+    def commit(self):
+        with self.out:
+            self.out.executemany("INSERT INTO evaluations VALUES (?,?,?,?)", self.evaluations)
+            self.out.executemany("INSERT OR REPLACE INTO checkpoint VALUES (?,?,?)", self.checkpoints)
+            self.out.executemany("INSERT OR REPLACE INTO harvested VALUES (?,?,?,?)", self.harvests)
+        self.evaluations = []
+        self.checkpoints = []
+        self.harvests = []
+        self.nboards = 0
+        self.last_commit = time.time()
+
+class LocalQueue:
+    """
+    The work queue of a single driver. Boards are taken from the
+    front of two deques, interrupted ones first, then the rest
+    by popularity; boards that are already done are skipped when
+    they come up. Progress is checkpointed into the output
+    database by a Writer.
+    """
+
+    def __init__(self, out, ranking, done):
+        self.out = out
+        self.writer = Writer(out)
+        self.done = set(done)
+        self.running = set()
+        inflight = []
+        for boardid, status in out.execute("select boardid, status from checkpoint"):
+            if status == "done":
+                self.done.add(boardid)
+            else:
+                inflight.append(boardid)
+        self.harvests = {}
+        for boardid, depth, score, pv in out.execute("select boardid, depth, score, pv from harvested"):
+            self.harvests[boardid] = (depth, score, pv)
+        print(f"Harvested evaluations: {len(self.harvests)}")
+        if inflight:
+            print(f"Resuming {len(inflight)} interrupted boards")
+        self.urgent = collections.deque(inflight)
+        self.todo = collections.deque(bid for bid, n in ranking)
+
+    def claim(self):
+        while self.urgent or self.todo:
+            bid = self.urgent.popleft() if self.urgent else self.todo.popleft()
+            if bid in self.done or bid in self.running: continue
+            self.running.add(bid)
+            self.writer.started(bid)
+            return bid
+        return None
+
+    def renew(self):
+        pass
+
+    def harvested(self, bid):
+        return self.harvests.get(bid, None)
+
+    def complete(self, bid, evaluation, harvests=()):
+        """Write the evaluation of a board; return True."""
+        self.running.discard(bid)
+        self.done.add(bid)
+        for hbid, depth, score, pv in harvests:
+            if hbid in self.done: continue
+            if depth > self.harvests.get(hbid, (0,))[0]:
+                self.harvests[hbid] = (depth, score, pv)
+                self.writer.harvested(hbid, depth, score, pv)
+        self.writer.finished(bid, evaluation)
+        return True
+
+    def close(self):
+        self.writer.commit()
+        self.out.execute("CREATE INDEX IF NOT EXISTS evaluations_boardid on evaluations(boardid)")
+        self.out.close()
+
+class LeaseQueue:
+    """
+    A work queue in a shared SQLite database, so that several
+    drivers, on different hosts or in different containers, can
+    split the job and write into one evaluations table.
+
+    A driver claims a board by leasing it for LEASE_TIME seconds,
+    renews its leases while the boards are analyzed, and completes
+    a board by writing its evaluation and marking it done in one
+    transaction. Leases of dead drivers expire, and their boards
+    get claimed again; a driver that lost its lease drops the
+    result instead of writing it twice.
+    """
+
+    def __init__(self, out, worker, ranking, done):
+        self.out = out
+        self.out.isolation_level = None
+        self.worker = worker
+        self.last_renew = time.time()
+        out.executescript("""
+            CREATE TABLE IF NOT EXISTS queue(boardid integer primary key, priority integer, status text, worker text, expires real);
+            CREATE INDEX IF NOT EXISTS queue_claim on queue(status, priority);
+        """)
+        with self.transaction():
+            if out.execute("select count(*) from queue").fetchone()[0] == 0:
+                print("Filling the queue")
+                out.executemany("INSERT OR IGNORE INTO queue VALUES (?,?,'todo',NULL,NULL)",
+                    ((bid, n) for bid, n in ranking if bid not in done))
+        self.done = set(done)
+        self.done.update(bid for bid, in out.execute("select boardid from queue where status='done'"))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.out.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.out.execute("ROLLBACK")
+            raise
+        else:
+            self.out.execute("COMMIT")
+
+    def claim(self):
+        now = time.time()
+        with self.transaction():
+            row = self.out.execute("select boardid from queue where status='leased' and expires<? order by priority desc limit 1", (now,)).fetchone()
+            if row is None:
+                row = self.out.execute("select boardid from queue where status='todo' order by priority desc limit 1").fetchone()
+            if row is None:
+                return None
+            bid, = row
+            self.out.execute("update queue set status='leased', worker=?, expires=? where boardid=?", (self.worker, now + LEASE_TIME, bid))
+        return bid
+
+    def renew(self):
+        now = time.time()
+        if now - self.last_renew < LEASE_TIME/4: return
+        with self.transaction():
+            self.out.execute("update queue set expires=? where status='leased' and worker=?", (now + LEASE_TIME, self.worker))
+        self.last_renew = now
+
+    def harvested(self, bid):
+        return self.out.execute("select depth, score, pv from harvested where boardid=?", (bid,)).fetchone()
+
+    def complete(self, bid, evaluation, harvests=()):
+        """
+        Write the evaluation of a board; return False if the lease
+        was lost, and it was not written.
+        """
+        with self.transaction():
+            row = self.out.execute("select status, worker from queue where boardid=?", (bid,)).fetchone()
+            if row != ("leased", self.worker):
+                print(f"Lost the lease of board {bid}, dropping the result")
+                return False
+            self.out.executemany("INSERT INTO evaluations VALUES (?,?,?,?)",
+                ((bid, depth, score, pv) for depth, score, pv in evaluation))
+            self.out.executemany("""
+                INSERT INTO harvested VALUES (?,?,?,?) ON CONFLICT(boardid) DO UPDATE
+                SET depth=excluded.depth, score=excluded.score, pv=excluded.pv
+                WHERE excluded.depth > harvested.depth
+            """, harvests)
+            self.out.execute("update queue set status='done', worker=?, expires=NULL where boardid=?", (self.worker, bid))
+        self.done.add(bid)
+        return True
+
+    def close(self):
+        self.out.execute("CREATE INDEX IF NOT EXISTS evaluations_boardid on evaluations(boardid)")
+        self.out.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the opening book positions.")
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS, help="number of engine processes")
+    parser.add_argument("-t", "--threads", type=int, default=THREADS, help="threads per engine")
+    parser.add_argument("--hash", type=int, default=HASH, help="total hash size in MB")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="average time budget per position in seconds")
+    parser.add_argument("-o", "--output", default=OUTPUT, help="output database (resumed if it exists)")
+    parser.add_argument("--queue", metavar="FILE", help="share the work with other drivers through this database (used instead of --output)")
+    args = parser.parse_args()
+
+    book = Book("bchess/data/openings.sqlite")
+
+    print("* Sorting positions")
+    ranking = book.ranking()
+    boardid2nmoves = dict(ranking)
+    nmoves_total = sum(boardid2nmoves.values())
+    print(f"Total positions: {len(boardid2nmoves)}")
+    print(f"Total moves: {nmoves_total}")
+    print(f"Highest move count: {ranking[0][1]}")
+    print(f"Lowest move count: {ranking[-1][1]}")
+
+    if args.queue:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        print(f"Sharing the work through {args.queue} as {worker_id}")
+        work = LeaseQueue(open_output(args.queue), worker_id, ranking, book.evaluated())
+    else:
+        work = LocalQueue(open_output(args.output), ranking, book.evaluated())
+    nsum = sum(boardid2nmoves.get(bid, 0) for bid in work.done)
+    print(f"Already done: {len(work.done)} of {len(boardid2nmoves)} boards")
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker, args=(args.threads, args.hash//args.jobs, tasks, results), daemon=True)
+        for i in range(args.jobs)
+    ]
+    for w in workers: w.start()
+    print(f"Started {args.jobs} engines with {args.threads} threads each")
+    # Maps the running boards to their reserved time budget.
+    running = {}
+    # The depths the last searches reached.
+    searched = collections.deque(maxlen=HARVEST_SAMPLES)
+    bank = 0.0
+    nmoves_mean = nmoves_total/len(boardid2nmoves)
+
+    def finish(bid, evaluation, t, reason=None, harvests=()):
+        nonlocal nsum
+        if not work.complete(bid, evaluation, harvests):
+            return
+        nsum += boardid2nmoves.get(bid, 0)
+        print(f"* Board #{len(work.done)}, id {bid} ({nsum/nmoves_total*100:.0f}% of moves so far)")
+        print(f" {book.epd(bid)}")
+        for depth, score, pv in evaluation[-4:]:
+            print(f" d{depth}, {score}, {pv[:5*10]}")
+        print(f" t -> {t:.1f}s, {reason}" if t is not None else " harvested")
+
+    def submit():
+        nonlocal bank
+        while len(running) < args.jobs:
+            bid = work.claim()
+            if bid is None: break
+            harvested = work.harvested(bid)
+            typical = sorted(searched)[len(searched)//2] if searched else MAXDEPTH
+            if harvested and harvested[0] >= typical - HARVEST_SLACK:
+                finish(bid, [harvested], None)
+                continue
+            scale = (boardid2nmoves.get(bid, 0)/nmoves_mean)**0.5
+            budget = args.budget*min(max(scale, 0.25), 4)
+            extra = min(bank, budget*BUDGET_EXTRA)
+            bank -= extra
+            running[bid] = budget + extra
+            tasks.put((bid, book.epd(bid), budget + extra))
+
+    try:
+        submit()
+        while running:
+            try:
+                bid, evaluation, t, reason = results.get(timeout=LEASE_TIME/8)
+            except queue.Empty:
+                work.renew()
+                continue
+            bank += max(running.pop(bid) - t, 0)
+            harvests = []
+            if evaluation:
+                depth, score, pv = evaluation[-1]
+                searched.append(depth)
+                harvests = list(harvest_pv(book.epd(bid), depth, score, pv, book.boardid))
+            finish(bid, evaluation, t, reason, harvests)
+            work.renew()
+            submit()
     finally:
-        f.write("""\
-COMMIT;
-CREATE INDEX evaluations_boardid on evaluations(boardid);
-PRAGMA foreign_keys=ON;
-""")
+        work.close()
+        for w in workers:
+            tasks.put(None)
+
+if __name__ == "__main__":
+    main()